@@ -13,18 +13,23 @@ limitations under the License.
 
 import threading
 import uploader
-from collections import deque
-from common.util import subscriber_manager
+from common.util import subscriber_manager, trace
+from common.util import metrics as prom
 from common.util.logger import get_logger
+from common.util.shared_deque import SharedDeque
 
 
 def main():
 
-    input_queue = deque(maxlen=20)
+    input_queue = SharedDeque(maxlen=20)
     input_threads = []
-    subscriber_manager.configure(get_logger(__name__), input_queue)
+    log = get_logger(__name__)
+    subscriber_manager.configure(log, input_queue)
+    metrics = prom.Metrics()
+    metrics.start(shared=False)
+    prom.serve(metrics, log)
     uploader_thread = threading.Thread(
-        target=uploader.start, args=(input_queue,)
+        target=uploader.start, args=(input_queue, trace.Tracer(metrics, 'cloud_connector'))
     )
 
     for thread in input_threads:
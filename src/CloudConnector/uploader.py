@@ -16,6 +16,7 @@ import botocore
 import os
 import re
 import time
+from common.util import trace
 from common.util.logger import get_logger
 
 log = get_logger(__name__)
@@ -40,7 +41,7 @@ def get_bucket():
     return regex.match(bucket).group(0)
 
 
-def start(input_queue):
+def start(input_queue, tracer=None):
 
     try:
 
@@ -63,19 +64,23 @@ def start(input_queue):
                 time.sleep(5)
 
         while True:
-            if input_queue:
-                message = input_queue.popleft()
-                log.debug(f"message = {message}")
+            try:
+                message = input_queue.popleft(block=True, timeout=1)
+            except IndexError:
+                continue
+            log.debug(f"message = {message}")
+            trace.enter(message, 'uploader')
 
-                try:
-                    s3.Bucket(bucket).put_object(Key=message['title'] + ".jpeg", Body=message['img'])
-                    # log.info("### UPLOAD DISABLED ###")
-                    log.info(f'uploaded {message["title"]}')
-                except Exception as e:
-                    log.error(str(e))
-            else:
-                time.sleep(0.005)
+            try:
+                s3.Bucket(bucket).put_object(Key=message['title'] + ".jpeg", Body=message['img'])
+                # log.info("### UPLOAD DISABLED ###")
+                log.info(f'uploaded {message["title"]}')
+            except Exception as e:
+                log.error(str(e))
                 continue
+            trace.leave(message)
+            if tracer is not None:
+                tracer.observe(message, message.get('camera_id'))
     except KeyboardInterrupt:
         log.info("Quitting...")
     finally:
@@ -0,0 +1,122 @@
+"""
+Copyright 2022 Intel Corporation
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+    http://www.apache.org/licenses/LICENSE-2.0
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import numpy as np
+
+# Label of tracks that may match detections of any label
+NO_LABEL = -1
+# associate() results for detections without a track
+NEW_TRACK = -1
+NO_TRACK = -2
+# Detections overlapping more than this ratio of a track are not new objects
+OVERLAP_RATIO = 0.2
+
+
+def rect_array(rects):
+    """
+    Return Rect objects as a (N, 4) array of x, y, width, height
+    """
+    return np.array([(r.x, r.y, r.width, r.height) for r in rects],
+                    dtype=np.float64).reshape(-1, 4)
+
+
+def intersection_areas(a, b):
+    """
+    Return the (N, M) matrix of intersection areas of rect arrays <a> and <b>
+    """
+    x1 = np.maximum(a[:, None, 0], b[None, :, 0])
+    y1 = np.maximum(a[:, None, 1], b[None, :, 1])
+    x2 = np.minimum(a[:, None, 0] + a[:, None, 2], b[None, :, 0] + b[None, :, 2])
+    y2 = np.minimum(a[:, None, 1] + a[:, None, 3], b[None, :, 1] + b[None, :, 3])
+    return np.where((x2 < x1) | (y2 < y1), 0, (x2 - x1) * (y2 - y1))
+
+
+def overlapping_pairs(rects):
+    """
+    Return index arrays (i, j), i < j, of the pairs of a rect array with a
+    positive intersection area. Rects are swept in x order so only pairs
+    overlapping in x are tested.
+    """
+    n = len(rects)
+    order = np.argsort(rects[:, 0], kind='stable')
+    starts = rects[order, 0]
+    stops = np.searchsorted(starts, starts + rects[order, 2], side='left')
+    counts = np.maximum(stops - np.arange(n) - 1, 0)
+    first = np.repeat(np.arange(n), counts)
+    offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    a, b = rects[order[first]], rects[order[first + 1 + offsets]]
+    width = np.minimum(a[:, 0] + a[:, 2], b[:, 0] + b[:, 2]) - np.maximum(a[:, 0], b[:, 0])
+    height = np.minimum(a[:, 1] + a[:, 3], b[:, 1] + b[:, 3]) - np.maximum(a[:, 1], b[:, 1])
+    keep = (width > 0) & (height > 0)
+    i, j = order[first][keep], order[first + 1 + offsets][keep]
+    return np.minimum(i, j), np.maximum(i, j)
+
+
+def associate(track_rects, track_labels, det_rects, det_labels, gating=None):
+    """
+    Match all detections to tracks at once.
+    A detection may match a track of the same label (or without label)
+    whose center is closer than half the detection area (squared
+    distance, as TrackingManager.find_tracker). Pairs are assigned greedily
+    by increasing cost, so every track takes at most one detection.
+    <gating>, an optional (tracks, detections) boolean matrix, further
+    restricts the pairs allowed to match.
+    Return, for each detection, the row of its track, NEW_TRACK or NO_TRACK
+    when it overlaps a track without matching one.
+    """
+    num_det = len(det_rects)
+    result = np.full(num_det, NEW_TRACK, dtype=np.int64)
+    det_area = det_rects[:, 2] * det_rects[:, 3]
+    if not num_det or not len(track_rects):
+        return _drop_duplicates(result, det_rects, det_area)
+    track_area = track_rects[:, 2] * track_rects[:, 3]
+    inter = intersection_areas(track_rects, det_rects)
+    iou = inter / np.maximum(track_area[:, None] + det_area[None, :] - inter, 1e-9)
+    overlap = inter / np.maximum(np.minimum(track_area[:, None], det_area[None, :]), 1e-9)
+    result[np.any(overlap > OVERLAP_RATIO, axis=0)] = NO_TRACK
+
+    track_centers = track_rects[:, :2] + track_rects[:, 2:] / 2
+    det_centers = det_rects[:, :2] + det_rects[:, 2:] / 2
+    distance = ((track_centers[:, None, :] - det_centers[None, :, :])**2).sum(axis=2)
+    gate = det_area[None, :] / 2
+    label_ok = ((track_labels[:, None] == det_labels[None, :]) |
+                (track_labels[:, None] == NO_LABEL))
+    valid = label_ok & (distance < gate)
+    if gating is not None:
+        valid &= gating
+    if not np.any(valid):
+        return _drop_duplicates(result, det_rects, det_area)
+
+    cost = distance / np.maximum(gate, 1e-9) + (1 - iou)
+    tracks, dets = np.nonzero(valid)
+    order = np.argsort(cost[tracks, dets], kind='stable')
+    used = np.zeros(len(track_rects), dtype=bool)
+    matched = np.zeros(num_det, dtype=bool)
+    for t, d in zip(tracks[order].tolist(), dets[order].tolist()):
+        if used[t] or matched[d]:
+            continue
+        used[t] = matched[d] = True
+        result[d] = t
+    return _drop_duplicates(result, det_rects, det_area)
+
+
+def _drop_duplicates(result, det_rects, det_area):
+    """
+    Keep only the first of new detections overlapping each other
+    """
+    new = np.flatnonzero(result == NEW_TRACK)
+    if len(new) > 1:
+        inter = intersection_areas(det_rects[new], det_rects[new])
+        overlap = inter / np.maximum(np.minimum(det_area[new, None], det_area[None, new]), 1e-9)
+        result[new[np.tril(overlap > OVERLAP_RATIO, -1).any(axis=1)]] = NO_TRACK
+    return result
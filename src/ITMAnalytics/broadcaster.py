@@ -0,0 +1,334 @@
+"""
+Copyright 2022 Intel Corporation
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+    http://www.apache.org/licenses/LICENSE-2.0
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+import asyncio
+import collections
+import itertools
+import threading
+import time
+import cv2
+import numpy as np
+from common.util import trace
+
+# Seconds the broadcaster waits for a frame before checking its subscribers
+POLL_INTERVAL = 1
+# Renditions other than the original kept per camera, unused ones are
+# evicted first
+MAX_RENDITIONS = 8
+# (width, quality) of the frames as encoded by the analytics
+ORIGINAL = (None, None)
+# Seconds a camera keeps sending frames after a snapshot request
+SNAPSHOT_LEASE = 10
+
+_PART_HEADER = (b' --frame\r\n'
+                b'Content-Type: image/jpeg\r\n\r\n')
+_PART_TRAILER = b'\r\n\r\n'
+
+
+def multipart(img):
+    """
+    Return JPEG <img> as a part of a multipart/x-mixed-replace stream
+    """
+    return _PART_HEADER + img + _PART_TRAILER
+
+
+def jpeg(chunk):
+    """
+    Return the JPEG image of multipart <chunk>
+    """
+    return chunk[len(_PART_HEADER):-len(_PART_TRAILER)]
+
+
+def decode(img):
+    """
+    Return the image of JPEG <img>, None if it cannot be decoded
+    """
+    return cv2.imdecode(np.frombuffer(img, np.uint8), cv2.IMREAD_COLOR)
+
+
+def encode(mat, width=None, quality=None):
+    """
+    Encode <mat> to JPEG, resized to <width> keeping the aspect ratio.
+    """
+    if width and width != mat.shape[1]:
+        height = max(1, round(mat.shape[0] * width / mat.shape[1]))
+        mat = cv2.resize(mat, (width, height), interpolation=cv2.INTER_AREA)
+    params = [cv2.IMWRITE_JPEG_QUALITY, quality] if quality else []
+    ret, img = cv2.imencode('.jpg', mat, params)
+    if not ret:
+        return None
+    return img.tobytes()
+
+
+class _Paced:
+    """
+    Frame rate cap of a subscriber, <fps> None for every frame
+    """
+
+    def __init__(self, fps=None):
+        self.interval = 1 / fps if fps else 0
+        self.next_time = 0
+
+    def due(self, now):
+        """
+        Return True if a frame broadcast at <now> goes to this subscriber
+        """
+        if now < self.next_time:
+            return False
+        # Keep the cadence unless more than a frame late
+        self.next_time = (self.next_time if now - self.next_time < self.interval else now) + self.interval
+        return True
+
+
+class Subscriber(_Paced):
+    """
+    Latest frame slot of one viewer. A frame not taken before the next one
+    arrives is dropped, so slow viewers skip frames without holding back
+    the others. At most <fps> frames per second are offered.
+    """
+
+    def __init__(self, fps=None):
+        super().__init__(fps)
+        self._cond = threading.Condition()
+        self._frame = None
+        self.dropped = 0
+
+    def offer(self, frame):
+        with self._cond:
+            if self._frame is not None:
+                self.dropped += 1
+            self._frame = frame
+            self._cond.notify()
+
+    def get(self, timeout=None):
+        """
+        Return the latest frame, waiting up to <timeout> seconds for it.
+        Return None on timeout.
+        """
+        with self._cond:
+            if not self._cond.wait_for(lambda: self._frame is not None, timeout):
+                return None
+            frame, self._frame = self._frame, None
+            return frame
+
+
+class AsyncSubscriber(_Paced):
+    """
+    Subscriber read from the asyncio event <loop>: producer threads hand
+    the frames over to the loop, so viewers hold no thread.
+    """
+
+    def __init__(self, loop, fps=None):
+        super().__init__(fps)
+        self._loop = loop
+        self._event = asyncio.Event()
+        self._frame = None
+        self.dropped = 0
+
+    def offer(self, frame):
+        try:
+            self._loop.call_soon_threadsafe(self._set, frame)
+        except RuntimeError:
+            # The loop is closed, nobody reads this subscriber anymore
+            pass
+
+    def _set(self, frame):
+        if self._frame is not None:
+            self.dropped += 1
+        self._frame = frame
+        self._event.set()
+
+    async def get(self, timeout=None):
+        """
+        Return the latest frame, waiting up to <timeout> seconds for it.
+        Return None on timeout.
+        """
+        try:
+            await asyncio.wait_for(self._event.wait(), timeout)
+        except asyncio.TimeoutError:
+            return None
+        self._event.clear()
+        frame, self._frame = self._frame, None
+        return frame
+
+
+class Rendition:
+    """
+    Subscribers of one (width, quality) rendition of a camera, with its
+    last chunk and the frame it was encoded from
+    """
+
+    def __init__(self):
+        self.subscribers = set()
+        self.chunk = None
+        self.source = None
+
+
+class Broadcaster:
+    """
+    Fan out the frames of camera <cam_id> to any number of viewers.
+    While there are subscribers, or for SNAPSHOT_LEASE seconds after a
+    snapshot, a thread pops the camera frames from <queue> and offers each
+    of them to every subscriber. Frames are dicts of the multipart 'chunk';
+    the latest one also has the frame 'seq' and 'capture_ts' of the video
+    inference and an 'etag' unique to the frame.
+    Viewers pick a (width, quality) rendition, each is encoded once per
+    frame for all its viewers, and only when one of them is due under its
+    frame rate cap. Frames are decoded for this, once, from the JPEG the
+    broadcaster owns, never from ring memory. Up to MAX_RENDITIONS renditions are cached besides the
+    original, the least recently used ones without viewers are evicted
+    for new ones.
+    The camera is marked in <camera_active> while it has subscribers, so
+    the analytics only send frames then.
+    """
+
+    def __init__(self, cam_id, queue, camera_active, mutex):
+        self.cam_id = cam_id
+        self.queue = queue
+        self.camera_active = camera_active
+        self.mutex = mutex
+        # Subscriber: its Rendition
+        self.subscribers = {}
+        # (width, quality): Rendition, least recently used first
+        self.renditions = collections.OrderedDict()
+        # Last frame broadcast, None while nobody watches
+        self.latest = None
+        # time.monotonic() until which snapshots keep the camera active
+        self.lease_end = 0
+        # ETags are the construction time and frame number, so they
+        # differ across restarts
+        self._etag_prefix = f'{time.time_ns():x}-{cam_id}-'
+        self._numbers = itertools.count(1)
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def _set_active(self, active):
+        self.mutex.acquire()
+        self.camera_active[self.cam_id] = active
+        self.mutex.release()
+
+    def _start(self):
+        # Called with the lock held
+        if self._thread is None:
+            self._set_active(True)
+            self._thread = threading.Thread(target=self._pump, daemon=True)
+            self._thread.start()
+
+    def _room(self, key):
+        """
+        Return whether rendition <key> can be subscribed to, and the key of
+        the rendition to evict for it if any
+        """
+        if key == ORIGINAL or key in self.renditions:
+            return True, None
+        keys = [k for k in self.renditions if k != ORIGINAL]
+        if len(keys) < MAX_RENDITIONS:
+            return True, None
+        for k in keys:
+            if not self.renditions[k].subscribers:
+                return True, k
+        return False, None
+
+    def has_room(self, rendition):
+        """
+        Return True if viewers can subscribe to <rendition>
+        """
+        with self._lock:
+            return self._room(rendition)[0]
+
+    def subscribe(self, subscriber=None, rendition=ORIGINAL):
+        """
+        Add <subscriber>, a new Subscriber by default, to <rendition>, a
+        (width, quality) pair of which None keeps the original, and return
+        it. Return None if MAX_RENDITIONS other renditions are in use.
+        """
+        if subscriber is None:
+            subscriber = Subscriber()
+        with self._lock:
+            room, evicted = self._room(rendition)
+            if not room:
+                return None
+            if evicted is not None:
+                del self.renditions[evicted]
+            entry = self.renditions.setdefault(rendition, Rendition())
+            self.renditions.move_to_end(rendition)
+            entry.subscribers.add(subscriber)
+            self.subscribers[subscriber] = entry
+            latest = self.latest
+            if latest is not None and entry.source is latest:
+                # Start with the current frame when it is encoded already
+                subscriber.offer(latest if rendition == ORIGINAL else {'chunk': entry.chunk})
+            self._start()
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        with self._lock:
+            entry = self.subscribers.pop(subscriber, None)
+            if entry is not None:
+                entry.subscribers.discard(subscriber)
+
+    def snapshot(self, timeout=0, lease=SNAPSHOT_LEASE):
+        """
+        Return the latest frame, waiting up to <timeout> seconds for one if
+        there is none yet. Return None if none came.
+        The camera keeps sending frames for <lease> seconds, so polling
+        viewers get recent frames without holding a subscription.
+        """
+        with self._lock:
+            self.lease_end = max(self.lease_end, time.monotonic() + lease)
+            self._start()
+            frame = self.latest
+        if frame is None and timeout:
+            subscriber = self.subscribe()
+            try:
+                frame = subscriber.get(timeout)
+            finally:
+                self.unsubscribe(subscriber)
+        return frame
+
+    def _pump(self):
+        while True:
+            with self._lock:
+                if not self.subscribers and time.monotonic() >= self.lease_end:
+                    self._set_active(False)
+                    self.latest = None
+                    self._thread = None
+                    return
+                renditions = [(key, entry, list(entry.subscribers))
+                              for key, entry in self.renditions.items() if entry.subscribers]
+            try:
+                item = self.queue.popleft(block=True, timeout=POLL_INTERVAL)
+            except IndexError:
+                continue
+            frame = {'chunk': multipart(item['img']),
+                     'seq': item.get(trace.SEQ), 'capture_ts': item.get(trace.CAPTURE_TS),
+                     'etag': self._etag_prefix + str(next(self._numbers))}
+            self.latest = frame
+            now = time.monotonic()
+            mat = None
+            for key, entry, subscribers in renditions:
+                due = [subscriber for subscriber in subscribers if subscriber.due(now)]
+                if not due:
+                    continue
+                if key == ORIGINAL:
+                    chunk = frame['chunk']
+                else:
+                    if mat is None:
+                        mat = decode(item['img'])
+                    img = encode(mat, *key) if mat is not None else None
+                    if img is None:
+                        continue
+                    chunk = multipart(img)
+                entry.chunk, entry.source = chunk, frame
+                offered = frame if key == ORIGINAL else {'chunk': chunk}
+                for subscriber in due:
+                    subscriber.offer(offered)
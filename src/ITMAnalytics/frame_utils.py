@@ -51,6 +51,14 @@ class Frame:
         except KeyError:
             return None
 
+    @property
+    def capture_ts(self):
+        """
+        Capture time (seconds since epoch) stamped by the video inference
+        service, None for frames without it
+        """
+        return self.in_frame.get('capture_ts')
+
     @property
     def roi(self):
         try:
@@ -69,6 +77,19 @@ class Frame:
     def __delete_raw_blob(self):
         self.in_frame.pop('frame', None)
 
+    def encoded_blob(self):
+        """
+        Return the JPEG blob as received and remove it from the frame,
+        or None if the frame is not JPEG encoded.
+        """
+        if self.encoding_type != "jpeg":
+            return None
+        blob = self.blob
+        self.__delete_raw_blob()
+        if isinstance(blob, list):
+            blob = blob[0]
+        return blob
+
     def decode_frame(self, log):
         encoding = None
         if self.encoding_type and self.encoding_level:
@@ -0,0 +1,238 @@
+"""
+Copyright 2022 Intel Corporation
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+    http://www.apache.org/licenses/LICENSE-2.0
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+import collections
+import itertools
+import numbers
+import os
+import threading
+import time
+from influxdb.exceptions import InfluxDBClientError
+from common.util.logger import get_logger
+
+log = get_logger(__name__)
+
+BATCH_SIZE = 500
+FLUSH_INTERVAL = 1.0
+JOURNAL_SIZE = 64 * 1024 * 1024
+# Seconds to wait before retrying a failed write, doubled on each failure
+MIN_BACKOFF = 1
+MAX_BACKOFF = 60
+# Journal batches replayed per flush, so replay does not delay new points
+REPLAY_BATCHES = 10
+
+
+def _escape(text, chars):
+    text = str(text).replace('\\', '\\\\')
+    for char in chars:
+        text = text.replace(char, '\\' + char)
+    return text
+
+
+def _value(value):
+    if isinstance(value, bool):
+        return 'true' if value else 'false'
+    if isinstance(value, numbers.Integral):
+        return f'{int(value)}i'
+    if isinstance(value, numbers.Real):
+        return repr(float(value))
+    return '"' + str(value).replace('\\', '\\\\').replace('"', '\\"') + '"'
+
+
+def line(measurement, fields, tags=None, timestamp=None):
+    """
+    Return a point in the InfluxDB line protocol. <timestamp> is in
+    nanoseconds, integer fields are written as integers.
+    """
+    key = _escape(measurement, ', ')
+    for tag, value in sorted((tags or {}).items()):
+        key += f",{_escape(tag, ',= ')}={_escape(value, ',= ')}"
+    field_set = ','.join(f"{_escape(field, ',= ')}={_value(value)}" for field, value in fields.items())
+    if timestamp is None:
+        return f'{key} {field_set}'
+    return f'{key} {field_set} {int(timestamp)}'
+
+
+class Journal:
+    """
+    Bounded on-disk spill of line protocol points.
+    Points are appended to <path>, which becomes <path>.1 once it holds
+    half of <max_bytes>, dropping the previous <path>.1 (the oldest
+    points). Points are read back oldest first.
+    """
+
+    def __init__(self, path, max_bytes=JOURNAL_SIZE):
+        self.path = path
+        self.rotated = path + '.1'
+        self.segment_size = max_bytes // 2
+        # Bytes of the oldest segment already read back
+        self.offset = 0
+        self._read = None
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+
+    def append(self, lines):
+        with open(self.path, 'ab') as fd:
+            fd.write(''.join(f'{point}\n' for point in lines).encode())
+            size = fd.tell()
+        if size >= self.segment_size:
+            if os.path.exists(self.rotated):
+                log.warning(f"InfluxDB journal full, dropping {os.path.getsize(self.rotated) - self.offset} bytes")
+                self.offset = 0
+            os.replace(self.path, self.rotated)
+
+    def _oldest(self):
+        for path in (self.rotated, self.path):
+            if os.path.exists(path):
+                return path
+        return None
+
+    def read(self, max_lines):
+        """
+        Return up to <max_lines> of the oldest points, which stay in the
+        journal until commit()
+        """
+        path = self._oldest()
+        if path is None:
+            return []
+        with open(path, 'rb') as fd:
+            fd.seek(self.offset)
+            lines = list(itertools.islice(fd, max_lines))
+        self._read = (path, sum(len(point) for point in lines))
+        return [point.decode().rstrip('\n') for point in lines]
+
+    def commit(self):
+        """
+        Remove the points returned by the last read()
+        """
+        path, size = self._read
+        self._read = None
+        if self._oldest() != path:
+            return
+        self.offset += size
+        if self.offset >= os.path.getsize(path):
+            os.remove(path)
+            self.offset = 0
+
+
+class InfluxWriter:
+    """
+    Write line protocol points to InfluxDB from a thread.
+    Points are batched and written when <batch_size> are pending or every
+    <flush_interval> seconds. Failed writes are retried with exponential
+    backoff; meanwhile points spill to a <journal> file, bounded to
+    <journal_size> bytes, replayed once InfluxDB is back. Points carry
+    their timestamp, so a batch written twice does not duplicate them.
+    Without journal points are dropped while InfluxDB is unreachable.
+    """
+
+    def __init__(self, client, batch_size=BATCH_SIZE, flush_interval=FLUSH_INTERVAL,
+                 journal=None, journal_size=JOURNAL_SIZE):
+        self.client = client
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.journal = Journal(journal, journal_size) if journal else None
+        self.pending = collections.deque()
+        self.cond = threading.Condition()
+        self.backoff = 0
+        self.retry_at = 0
+        self.running = False
+        self.written = 0
+        self.spilled = 0
+        self.dropped = 0
+
+    def start(self):
+        self.th = threading.Thread(target=self._run, args=())
+        self.running = True
+        self.th.daemon = True
+        self.th.start()
+
+    def stop(self):
+        """
+        Stop the thread after a last flush
+        """
+        with self.cond:
+            self.running = False
+            self.cond.notify()
+        self.th.join()
+
+    def write(self, lines):
+        with self.cond:
+            self.pending.extend(lines)
+            if len(self.pending) >= self.batch_size:
+                self.cond.notify()
+
+    def _run(self):
+        while self.running:
+            with self.cond:
+                self.cond.wait_for(lambda: len(self.pending) >= self.batch_size or not self.running,
+                                   timeout=self.flush_interval)
+            self.flush()
+
+    def _take(self):
+        with self.cond:
+            return [self.pending.popleft() for _ in range(min(len(self.pending), self.batch_size))]
+
+    def flush(self):
+        """
+        Write the pending points, then replay journal points
+        """
+        batch = self._take()
+        while batch:
+            if not self._send(batch):
+                self._spill(batch)
+            batch = self._take()
+        if self.journal is None:
+            return
+        for _ in range(REPLAY_BATCHES):
+            lines = self.journal.read(self.batch_size)
+            if not lines or not self._send(lines):
+                break
+            self.journal.commit()
+
+    def _send(self, lines):
+        """
+        Write <lines>, return False if they must be retried later
+        """
+        if time.monotonic() < self.retry_at:
+            return False
+        try:
+            self.client.write_points(lines, time_precision='n', protocol='line')
+        except InfluxDBClientError as err:
+            if err.code is not None and 400 <= err.code < 500:
+                # Retrying rejected points does not help
+                log.error(f"InfluxDB rejected {len(lines)} points: {err}")
+                self.dropped += len(lines)
+                return True
+            self._retry_later(err)
+            return False
+        except Exception as err:
+            self._retry_later(err)
+            return False
+        self.backoff = 0
+        self.written += len(lines)
+        return True
+
+    def _retry_later(self, err):
+        self.backoff = min(max(self.backoff * 2, MIN_BACKOFF), MAX_BACKOFF)
+        self.retry_at = time.monotonic() + self.backoff
+        log.warning(f"InfluxDB write failed, retrying in {self.backoff}s: {err}")
+
+    def _spill(self, lines):
+        if self.journal is None:
+            self.dropped += len(lines)
+            return
+        try:
+            self.journal.append(lines)
+            self.spilled += len(lines)
+        except OSError as err:
+            log.error(f"InfluxDB journal write failed: {err}")
+            self.dropped += len(lines)
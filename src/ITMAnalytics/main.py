@@ -12,23 +12,29 @@ limitations under the License.
 """
 
 
-import cv2
+import asyncio
 import influxdb
 import json
 import jsonschema
-import math
 import multiprocessing as mp
-import numpy as np
 import os
 import psycopg2
 import smartcity
 import sys
 import threading
 import time
-from common.util import subscriber_manager, publisher_manager
+from broadcaster import AsyncSubscriber, Broadcaster, Subscriber, jpeg
+from common.util import asgi
+from common.util import metrics as prom
+from common.util import image_channel, subscriber_manager, publisher_manager
 from common.util.logger import get_logger
-from common.util.shared_deque import SharedDequeManager
-from flask import Flask, Response
+from common.util.shm_ring import ShmRingManager, DEFAULT_SLOT_SIZE
+from flask import Flask, Response, jsonify, request
+from werkzeug.http import parse_etags, quote_etag
+from influx_writer import BATCH_SIZE, FLUSH_INTERVAL, JOURNAL_SIZE
+from mosaic import MOSAIC_FPS, Mosaic
+from rolling_stats import RESOLUTIONS, RollingStats
+from tracker import InfluxDB, SCHEMA_LEGACY
 
 mp.set_start_method("spawn", force=True)
 
@@ -43,6 +49,31 @@ PSQL_USER = os.getenv("PSQL_USER")
 PSQL_PASS = os.getenv("PSQL_PASS")
 INFLUX_USER = os.getenv("INFLUX_USER")
 INFLUX_PASS = os.getenv("INFLUX_PASS")
+# Seconds before an InfluxDB request fails, writes are retried by InfluxWriter
+INFLUX_TIMEOUT = 10
+# Seconds a stream waits for a new frame before giving up
+STREAM_TIMEOUT = 40
+# Highest frame rate cap a viewer can ask for
+MAX_STREAM_FPS = 60
+# Seconds a snapshot waits for a frame of a camera nobody watched
+SNAPSHOT_TIMEOUT = 2
+# Snapshots change with every frame, clients revalidate them with ETags
+SNAPSHOT_CACHE_CONTROL = 'no-cache'
+# Tail of the /camera/<cam_id> snapshot route
+SNAPSHOT_PATH = '/latest.jpg'
+# TLS certificate and key of the web server
+SSL_CONTEXT = ('/app/itm.pem', '/app/itm-key.pem')
+MJPEG_MIMETYPE = 'multipart/x-mixed-replace; boundary=frame'
+SECURITY_HEADERS = {
+    'Strict-Transport-Security': 'max-age=31536000; includeSubDomains',
+    'Content-Security-Policy': "frame-ancestors 'none' https://*:32000 https://*:30300;"
+                               "media-src 'none' ; "
+                               "object-src 'none' ; "
+                               "connect-src 'none' ; "
+                               "plugin-src 'none' ; "
+                               "frame-src 'none' ; "
+                               "img-src 'self' https://openlayers.org http://a.tile.openstreetmap.org http://b.tile.openstreetmap.org http://c.tile.openstreetmap.org https://*:30303  ; "
+}
 
 app = Flask(__name__)
 
@@ -59,8 +90,12 @@ class GlobalData:
         self.conf_data = None
         self.mutex = None
         self.q_data = None
-        self.current_frames = None
+        self.broadcasters = None
+        self.mosaic = None
         self.camera_active = None
+        self.metrics = None
+        self.publish_queue = None
+        self.stats = None
 
 _GData = GlobalData()
 
@@ -120,50 +155,23 @@ class PsqlConn:
         self.conn.close()
 
 
-def _get_all_streams(num_ch):
+def _get_all_streams():
     """
     Generator.
-    Combine and yield frames from all running video streams.
+    Yield the mosaic of all running video streams, composed once for
+    all viewers.
     """
-    height, width = 320, 640
-    num_rows = math.floor(math.sqrt(num_ch))
-    num_cols = math.ceil(num_ch/num_rows)
-    _GData.mutex.acquire()
-    for i in range(num_ch):
-        _GData.camera_active[i] = True
-    _GData.mutex.release()
-    empty_frame = np.zeros((height,width,3), np.uint8)
+    subscriber = _GData.mosaic.subscribe()
     try:
         while True:
-            rows = []
-            for r in range(0, num_rows):
-                cols = []
-                for c in range(0, num_cols):
-                    if not _GData.q_data[r+c]:
-                        if _GData.current_frames[r+c] is None:
-                            cols.append(empty_frame.copy())
-                        else:
-                            cols.append(_GData.current_frames[r+c].copy())
-                    else:
-                        frame = _GData.q_data[r+c].popleft()
-                        _GData.current_frames[r+c] = frame
-                        cols.append(frame)
-                rows.append(cols)
-            base = cv2.vconcat([cv2.hconcat(h_list) for h_list in rows])
-            ret, base_en = cv2.imencode('.jpg', base.copy())
-            if not ret:
-                continue
-            yield (b' --frame\r\n'
-                   b'Content-Type: image/jpeg\r\n\r\n' +
-                   base_en.copy().tobytes() + b'\r\n\r\n')
+            # The mosaic only changes when cameras send frames
+            chunk = subscriber.get(timeout=STREAM_TIMEOUT)
+            if chunk is not None:
+                yield chunk
     except Exception as err:
         log.error(f'Error: {err}')
     finally:
-        for idx in range(num_ch):
-            if _GData.current_frames[idx] is None:
-                _GData.mutex.acquire()
-                _GData.camera_active[idx] = False
-                _GData.mutex.release()
+        _GData.mosaic.unsubscribe(subscriber)
 
 
 @app.route('/get_all_streams')
@@ -171,54 +179,90 @@ def get_all_streams():
     """
     Route to show all running video streams
     """
-    return Response(_get_all_streams(_GData.num_channels),
-                    mimetype='multipart/x-mixed-replace; boundary=frame')
+    return Response(_get_all_streams(), mimetype=MJPEG_MIMETYPE)
 
 
-def _stream_channel(cam_id):
+async def _async_all_streams():
+    """
+    Async generator.
+    Same as _get_all_streams(), for the event loop of the ASGI mode.
+    """
+    subscriber = _GData.mosaic.subscribe(AsyncSubscriber(asyncio.get_running_loop()))
+    try:
+        while True:
+            chunk = await subscriber.get(timeout=STREAM_TIMEOUT)
+            if chunk is not None:
+                yield chunk
+    finally:
+        _GData.mosaic.unsubscribe(subscriber)
+
+
+def _stream_channel(cam_id, width=None, quality=None, fps=None):
     """
     Generator.
     Yield frames that belongs to <cam_id>.
+    Frames are streamed as encoded by the analytics, or in the rendition
+    of a different <width> or <quality>, at most <fps> per second.
+    Every viewer subscribes to the camera broadcaster, which encodes each
+    rendition once for all its viewers, and gets the latest frame, slow
+    viewers skip frames.
     """
     log.info("==============")
     log.info(cam_id)
     log.info("==============")
-    _GData.mutex.acquire()
-    _GData.camera_active[cam_id] = True
-    _GData.mutex.release()
-    queue = _GData.q_data[cam_id]
-    max_try = 40000
+    broadcaster = _GData.broadcasters[cam_id]
+    subscriber = broadcaster.subscribe(Subscriber(fps), (width, quality))
+    if subscriber is None:
+        log.error('Too many stream renditions.')
+        return
     try:
         while True:
-            if not queue and max_try > 0:
-                max_try -= 1
-                time.sleep(0.001)
-                continue
-            elif not queue and max_try <= 0:
+            frame = subscriber.get(timeout=STREAM_TIMEOUT)
+            if frame is None:
                 log.error('Unable to receive frames from pipeline, Unknown error.')
                 break
-            max_try = 40000
-            if queue:
-                try:
-                    frame = queue.popleft()
-                except Exception:  #nosec
-                    continue
-            else:
-                continue
-            _GData.current_frames[cam_id] = frame
-            ret, frame = cv2.imencode('.jpg', frame)
-            if not ret:
-                continue
-            yield (b' --frame\r\n'
-                   b'Content-Type: image/jpeg\r\n\r\n' +
-                   frame.tobytes() + b'\r\n\r\n')
+            yield frame['chunk']
     except Exception as err:
         log.error(f'Error: {err}')
     finally:
-        _GData.mutex.acquire()
-        _GData.camera_active[cam_id] = False
-        _GData.mutex.release()
-        _GData.current_frames[cam_id] = None
+        broadcaster.unsubscribe(subscriber)
+
+async def _async_stream_channel(cam_id, width=None, quality=None, fps=None):
+    """
+    Async generator.
+    Same as _stream_channel(), for the event loop of the ASGI mode.
+    """
+    broadcaster = _GData.broadcasters[cam_id]
+    subscriber = broadcaster.subscribe(AsyncSubscriber(asyncio.get_running_loop(), fps), (width, quality))
+    if subscriber is None:
+        log.error('Too many stream renditions.')
+        return
+    try:
+        while True:
+            frame = await subscriber.get(timeout=STREAM_TIMEOUT)
+            if frame is None:
+                log.error('Unable to receive frames from pipeline, Unknown error.')
+                break
+            yield frame['chunk']
+    finally:
+        broadcaster.unsubscribe(subscriber)
+
+
+def _check_stream(cam_id, width, quality, fps):
+    """
+    Return the (message, status) error of an invalid /camera/<cam_id>
+    request, None if it is valid
+    """
+    if not cam_id.isnumeric() or int(cam_id) >= _GData.num_channels:
+        return "The URL does not exist", 401
+    if (width is not None and not 16 <= width <= 4096) or \
+       (quality is not None and not 1 <= quality <= 100) or \
+       (fps is not None and not 1 <= fps <= MAX_STREAM_FPS):
+        return "Invalid stream parameters", 400
+    if not _GData.broadcasters[int(cam_id)].has_room((width, quality)):
+        return "Too many stream renditions", 503
+    return None
+
 
 @app.route('/camera/<cam_id>')
 def open_stream(cam_id):
@@ -226,35 +270,172 @@ def open_stream(cam_id):
     Route to individual video stream identified by <cam_id>.
     If <cam_id> is 'all' render HTML that shows all video streams.
     Calls _stream_channel(cam_id) function.
+    Optional query parameters: w (frame width), q (JPEG quality), fps
+    (maximum frames per second).
     """
     try:
-        if not cam_id.isnumeric():
-            return Response("The URL does not exist", 401)
-        cam_id = int(cam_id)
-        if cam_id >= _GData.num_channels:
-            return Response("The URL does not exist", 401)
-        return Response(_stream_channel(cam_id),
-                        mimetype='multipart/x-mixed-replace; boundary=frame')
+        width = request.args.get('w', type=int)
+        quality = request.args.get('q', type=int)
+        fps = request.args.get('fps', type=int)
+        error = _check_stream(cam_id, width, quality, fps)
+        if error is not None:
+            return Response(*error)
+        return Response(_stream_channel(int(cam_id), width, quality, fps), mimetype=MJPEG_MIMETYPE)
     except Exception as err:
         log.error(f'Error: {err}')
 
 
+@app.route('/camera/<cam_id>/latest.jpg')
+def get_snapshot(cam_id):
+    """
+    Route to the latest annotated frame of camera <cam_id> in JPEG,
+    served from memory. Clients sending the ETag of the current frame in
+    If-None-Match get 304.
+    """
+    if not cam_id.isnumeric() or int(cam_id) >= _GData.num_channels:
+        return Response("The URL does not exist", 401)
+    frame = _GData.broadcasters[int(cam_id)].snapshot(SNAPSHOT_TIMEOUT)
+    if frame is None:
+        response = Response("No frame available", 503)
+        response.headers['Retry-After'] = '1'
+        return response
+    if request.if_none_match.contains_weak(frame['etag']):
+        response = Response(status=304)
+    else:
+        response = Response(jpeg(frame['chunk']), mimetype='image/jpeg')
+    response.set_etag(frame['etag'])
+    response.headers['Cache-Control'] = SNAPSHOT_CACHE_CONTROL
+    return response
+
+
+@app.route('/cameras/latest')
+def get_snapshots():
+    """
+    Route to the latest frame of every camera in JSON: frame sequence
+    number, capture time, ETag and snapshot URL. Like snapshots, it keeps
+    the cameras sending frames; cameras without a frame yet have a null
+    sequence number.
+    """
+    cameras = []
+    for cam_id, broadcaster in enumerate(_GData.broadcasters):
+        frame = broadcaster.snapshot() or {}
+        cameras.append({'camera': cam_id,
+                        'address': _GData.conf_data[cam_id]['address'],
+                        'seq': frame.get('seq'),
+                        'capture_ts': frame.get('capture_ts'),
+                        # As sent in the ETag header
+                        'etag': quote_etag(frame['etag']) if frame else None,
+                        'url': f'/camera/{cam_id}/latest.jpg'})
+    response = jsonify({'cameras': cameras})
+    response.headers['Cache-Control'] = SNAPSHOT_CACHE_CONTROL
+    return response
+
+
+@app.route('/metrics')
+def get_metrics():
+    """
+    Route to the analytics metrics in Prometheus text format.
+    Queues read by this process are sampled here, the others by the
+    analytics processes.
+    """
+    metrics = _GData.metrics
+    for ch_id in range(_GData.num_channels):
+        queue = _GData.q_data[ch_id]
+        metrics.get('itm_analytics_queue_depth', queue='streams', channel=ch_id).set(len(queue))
+        metrics.get('itm_analytics_queue_dropped_total', queue='streams', channel=ch_id).set(queue.overflow())
+    queue = _GData.publish_queue
+    metrics.get('itm_analytics_queue_depth', queue='publish').set(len(queue))
+    metrics.get('itm_analytics_queue_dropped_total', queue='publish').set(queue.overflow())
+    return Response(metrics.render(), content_type=prom.CONTENT_TYPE)
+
+
+@app.route('/stats/<cam_id>')
+def get_stats(cam_id):
+    """
+    Route to the rolling aggregates of camera <cam_id> in JSON: counts,
+    flow and event rates per minute and per hour.
+    Optional query parameters: minutes (default 60), hours (default 24).
+    """
+    if not cam_id.isnumeric() or int(cam_id) >= _GData.num_channels:
+        return Response("The URL does not exist", 401)
+    minutes = request.args.get('minutes', 60, type=int)
+    hours = request.args.get('hours', 24, type=int)
+    if not (1 <= minutes <= RESOLUTIONS['1m'][1] and 1 <= hours <= RESOLUTIONS['1h'][1]):
+        return Response("Invalid stats parameters", 400)
+    stats = _GData.stats.summary(int(cam_id), minutes, hours)
+    stats['camera'] = int(cam_id)
+    stats['address'] = _GData.conf_data[int(cam_id)]['address']
+    return jsonify(stats)
+
+
 @app.after_request
 def add_headers(response):
-    response.headers['Strict-Transport-Security'] = 'max-age=31536000; includeSubDomains'
-    response.headers['Content-Security-Policy']  =  "frame-ancestors 'none' https://*:32000 https://*:30300;" \
-                                                "media-src 'none' ; " \
-                                                "object-src 'none' ; " \
-                                                "connect-src 'none' ; " \
-                                                "plugin-src 'none' ; " \
-                                                "frame-src 'none' ; " \
-                                                "img-src 'self' https://openlayers.org http://a.tile.openstreetmap.org http://b.tile.openstreetmap.org http://c.tile.openstreetmap.org https://*:30303  ; "
+    for name, value in SECURITY_HEADERS.items():
+        response.headers[name] = value
     return response
 
 
-def start_flask():
-    app.run(host=LOCAL_HOST, port=LOCAL_PORT,
-        threaded=True, ssl_context=('/app/itm.pem', '/app/itm-key.pem'))
+def _asgi_camera(path, query, headers):
+    """
+    ASGI route of /camera/<cam_id> and /camera/<cam_id>/latest.jpg,
+    invalid requests are answered by Flask
+    """
+    if path.endswith(SNAPSHOT_PATH):
+        cam_id = path[:-len(SNAPSHOT_PATH)]
+        if not cam_id.isnumeric() or int(cam_id) >= _GData.num_channels:
+            return None
+        return _async_snapshot(int(cam_id), headers.get('if-none-match'))
+    width = asgi.query_int(query, 'w')
+    quality = asgi.query_int(query, 'q')
+    fps = asgi.query_int(query, 'fps')
+    if _check_stream(path, width, quality, fps) is not None:
+        return None
+    return asgi.StreamResponse(_async_stream_channel(int(path), width, quality, fps), MJPEG_MIMETYPE)
+
+
+async def _async_snapshot(cam_id, if_none_match):
+    """
+    Same as get_snapshot(), for the event loop of the ASGI mode: waiting
+    for the first frame of a camera holds no thread.
+    """
+    broadcaster = _GData.broadcasters[cam_id]
+    frame = broadcaster.snapshot()
+    if frame is None:
+        subscriber = broadcaster.subscribe(AsyncSubscriber(asyncio.get_running_loop()))
+        try:
+            frame = await subscriber.get(timeout=SNAPSHOT_TIMEOUT)
+        finally:
+            broadcaster.unsubscribe(subscriber)
+    if frame is None:
+        return asgi.StreamResponse(asgi.chunks(b'No frame available'), 'text/html; charset=utf-8', 503,
+                                   {'Retry-After': '1'})
+    headers = {'ETag': quote_etag(frame['etag']), 'Cache-Control': SNAPSHOT_CACHE_CONTROL}
+    if parse_etags(if_none_match).contains_weak(frame['etag']):
+        return asgi.StreamResponse(asgi.chunks(), None, 304, headers)
+    return asgi.StreamResponse(asgi.chunks(jpeg(frame['chunk'])), 'image/jpeg', headers=headers)
+
+
+def _asgi_all_streams(path, query, headers):
+    """
+    ASGI route of /get_all_streams
+    """
+    if path:
+        return None
+    return asgi.StreamResponse(_async_all_streams(), MJPEG_MIMETYPE)
+
+
+def start_flask(serving_mode='flask'):
+    """
+    Serve the routes with the Flask development server, one thread per
+    request, or in 'asgi' <serving_mode> with the streams on one asyncio
+    event loop
+    """
+    if serving_mode == 'asgi':
+        asgi_app = asgi.App(app, {'/camera/': _asgi_camera, '/get_all_streams': _asgi_all_streams},
+                            SECURITY_HEADERS)
+        asgi.serve(asgi_app, LOCAL_HOST, LOCAL_PORT, SSL_CONTEXT)
+    else:
+        app.run(host=LOCAL_HOST, port=LOCAL_PORT, threaded=True, ssl_context=SSL_CONTEXT)
 
 def insert_entries():
     server_ip = f'{HOST_IP}:{SERVER_PORT}'
@@ -275,25 +456,48 @@ def main():
         json_schema = json.load(fd)
     jsonschema.validate(instance=json_config, schema=json_schema)
     frames_queue_size = json_config["frames_queue_size"]
+    shm_slot_size = json_config.get("shm_slot_size", DEFAULT_SLOT_SIZE)
     _GData.num_channels = len(os.getenv("SUBSCRIBER_TOPIC").split())
     _GData.conf_data = list(json_config['cameras'])
 
     collision = json_config['detect_collision']
     tracking = json_config['tracking'] or collision
+    lazy_render = json_config.get('lazy_render', False)
+    analytics_options = {'tracker_engine': json_config.get('tracker_engine', 'threaded'),
+                         'motion_model': json_config.get('motion_model', 'average'),
+                         'max_frame_skip': json_config.get('max_frame_skip', 1)}
+    writer_options = {'batch_size': json_config.get('influx_batch_size', BATCH_SIZE),
+                      'flush_interval': json_config.get('influx_flush_interval', FLUSH_INTERVAL),
+                      'journal': json_config.get('influx_journal'),
+                      'journal_size': json_config.get('influx_journal_size', JOURNAL_SIZE)}
+    _GData.stats = RollingStats(_GData.num_channels)
+    influx_options = {'writer_options': writer_options,
+                      'schema': json_config.get('influx_schema', SCHEMA_LEGACY),
+                      'node': DASHBOARD_NAME,
+                      'stats': _GData.stats}
+    # 1 runs all channels in one process, 0 uses one worker per core
+    num_workers = json_config.get('analytics_workers', 1) or os.cpu_count()
+    num_workers = max(1, min(num_workers, _GData.num_channels))
 
     _GData.mutex = mp.Lock()
     manager = mp.Manager()
-    mgr = SharedDequeManager()
-    mgr.start()
-    publish_queue = mgr.deque(maxlen=frames_queue_size)
+    # Frames move between the subscribers, the analytics process and the
+    # streaming threads through shared memory rings instead of manager proxies
+    rings = ShmRingManager(shm_slot_size)
+    publish_queue = rings.deque(maxlen=frames_queue_size)
+    _GData.publish_queue = publish_queue
     _GData.camera_active = manager.list([False] * _GData.num_channels)
-    _GData.q_data = {key:mgr.deque(maxlen=frames_queue_size) for key in range(0, _GData.num_channels)}
-    _GData.current_frames = [None] * _GData.num_channels
+    _GData.q_data = {key:rings.deque(maxlen=frames_queue_size) for key in range(0, _GData.num_channels)}
+    _GData.broadcasters = [Broadcaster(i, _GData.q_data[i], _GData.camera_active, _GData.mutex)
+                           for i in range(_GData.num_channels)]
+    _GData.mosaic = Mosaic(_GData.broadcasters, json_config.get('mosaic_fps', MOSAIC_FPS))
     try:
         client = influxdb.InfluxDBClient(host=INFLUXDB_HOST, port=INFLUXDB_PORT,
                                          username=INFLUX_USER,
                                          password=INFLUX_PASS,
-                                         database="itm_metadata")
+                                         database="itm_metadata",
+                                         timeout=INFLUX_TIMEOUT,
+                                         gzip=True)
         # test and retry connecting influxdb
         i = -1
         while i<=20:
@@ -318,21 +522,53 @@ def main():
         sys.exit(-1)
     insert_entries()
 
+    _GData.metrics = prom.Metrics()
+    smartcity.declare_metrics(_GData.metrics, _GData.num_channels)
+    _GData.metrics.start()
+    _GData.stats.start()
+    analytics_options['metrics'] = _GData.metrics
+
+    processes = []
     try:
-       threading.Thread(target=start_flask).start()
-       subscriber_manager.configure(log, queue_dict, mgr, frames_queue_size)
-       publisher_manager.configure(log, publish_queue, mgr, frames_queue_size)
-       process = mp.Process(target=smartcity.start_app, args=(_GData.conf_data, tracking, collision,
-                                                              client, _GData.q_data, _GData.camera_active, queue_dict,
-                                                              publish_queue))
-       process.start()
+       threading.Thread(target=start_flask, args=(json_config.get('serving_mode', 'flask'),)).start()
+       subscriber_manager.configure(log, queue_dict, rings, frames_queue_size)
+       publisher_manager.configure(log, publish_queue, rings, frames_queue_size,
+                                   split_images=image_channel.is_split())
+       if num_workers == 1:
+           processes.append(mp.Process(target=smartcity.start_app, args=(_GData.conf_data, tracking, collision,
+                                                                         client, _GData.q_data, _GData.camera_active, queue_dict,
+                                                                         publish_queue, lazy_render),
+                                        kwargs=dict(analytics_options, influx_options=influx_options)))
+       else:
+           # Channels are sharded across worker processes, which send their
+           # counts to the single InfluxDB writer of this process
+           influx_updates = mp.Queue()
+           writer = InfluxDB(client, _GData.num_channels, _GData.conf_data, **influx_options)
+           writer.listen(influx_updates)
+           writer.start()
+           for worker in range(num_workers):
+               channels = list(range(worker, _GData.num_channels, num_workers))
+               processes.append(mp.Process(target=smartcity.start_app, args=(_GData.conf_data, tracking, collision,
+                                                                             None, _GData.q_data, _GData.camera_active, queue_dict,
+                                                                             publish_queue, lazy_render, channels,
+                                                                             influx_updates),
+                                            kwargs=analytics_options))
+       log.info(f"Starting {len(processes)} analytics process(es)")
+       for process in processes:
+           process.start()
        while mp.active_children():
            time.sleep(1)
-       process.join()
+       for process in processes:
+           process.join()
 
     except KeyboardInterrupt:
-       process.join()
-       process.terminate()
+       for process in processes:
+           process.join()
+           process.terminate()
+    finally:
+       rings.shutdown()
+       _GData.metrics.unlink()
+       _GData.stats.unlink()
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,112 @@
+"""
+Copyright 2022 Intel Corporation
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+    http://www.apache.org/licenses/LICENSE-2.0
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+import math
+import threading
+import time
+import cv2
+import numpy as np
+from broadcaster import Subscriber, decode, jpeg, multipart
+
+MOSAIC_FPS = 10
+# Width and height of a camera cell
+CELL_SIZE = (640, 320)
+
+
+class Mosaic:
+    """
+    Grid of all cameras, composed in one preallocated canvas.
+    While there are subscribers, a thread subscribes to the camera
+    <broadcasters> and, at most <fps> times per second, resizes the
+    cameras with a new frame into their cell and encodes the canvas once
+    for all subscribers. Only the latest frame of each camera is decoded. Nothing is encoded while no camera has a new
+    frame.
+    """
+
+    def __init__(self, broadcasters, fps=MOSAIC_FPS, cell_size=CELL_SIZE):
+        self.broadcasters = broadcasters
+        self.interval = 1 / fps
+        self.cell_width, self.cell_height = cell_size
+        num_ch = len(broadcasters)
+        self.num_rows = max(1, math.floor(math.sqrt(num_ch)))
+        self.num_cols = max(1, math.ceil(num_ch / self.num_rows))
+        self.canvas = np.zeros((self.num_rows * self.cell_height, self.num_cols * self.cell_width, 3), np.uint8)
+        self.cells = [self._cell(i) for i in range(num_ch)]
+        self.subscribers = set()
+        # Last mosaic chunk, sent to new subscribers right away
+        self.latest = None
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def _cell(self, index):
+        r, c = divmod(index, self.num_cols)
+        return self.canvas[r * self.cell_height:(r + 1) * self.cell_height,
+                           c * self.cell_width:(c + 1) * self.cell_width]
+
+    def subscribe(self, subscriber=None):
+        """
+        Add <subscriber>, a new Subscriber by default, and return it
+        """
+        if subscriber is None:
+            subscriber = Subscriber()
+        with self._lock:
+            self.subscribers.add(subscriber)
+            if self.latest is not None:
+                subscriber.offer(self.latest)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._compose, daemon=True)
+                self._thread.start()
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        with self._lock:
+            self.subscribers.discard(subscriber)
+
+    def _update_cell(self, index, mat):
+        cell = self.cells[index]
+        if mat.shape == cell.shape:
+            cell[:] = mat
+        else:
+            cell[:] = cv2.resize(mat, (self.cell_width, self.cell_height), interpolation=cv2.INTER_AREA)
+
+    def _compose(self):
+        feeds = [broadcaster.subscribe() for broadcaster in self.broadcasters]
+        try:
+            next_time = time.monotonic()
+            while True:
+                with self._lock:
+                    if not self.subscribers:
+                        self.latest = None
+                        self._thread = None
+                        return
+                    subscribers = list(self.subscribers)
+                updated = False
+                for index, feed in enumerate(feeds):
+                    frame = feed.get(timeout=0)
+                    mat = decode(jpeg(frame['chunk'])) if frame is not None else None
+                    if mat is not None:
+                        self._update_cell(index, mat)
+                        updated = True
+                if updated:
+                    ret, img = cv2.imencode('.jpg', self.canvas)
+                    if ret:
+                        self.latest = multipart(img.tobytes())
+                        for subscriber in subscribers:
+                            subscriber.offer(self.latest)
+                next_time = max(next_time + self.interval, time.monotonic())
+                time.sleep(max(0, next_time - time.monotonic()))
+        finally:
+            for broadcaster, feed in zip(self.broadcasters, feeds):
+                broadcaster.unsubscribe(feed)
+            with self._lock:
+                if self._thread is threading.current_thread():
+                    self._thread = None
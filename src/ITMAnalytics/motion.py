@@ -0,0 +1,83 @@
+"""
+Copyright 2022 Intel Corporation
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+    http://www.apache.org/licenses/LICENSE-2.0
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import numpy as np
+
+# Motion models selectable with the motion_model setting
+MOTION_AVERAGE = 'average'
+MOTION_KALMAN = 'kalman'
+MOTION_MODELS = (MOTION_AVERAGE, MOTION_KALMAN)
+
+# Chi-square 0.99 quantile with 2 degrees of freedom
+GATING_THRESHOLD = 9.21
+
+
+class KalmanModel:
+    """
+    Constant acceleration Kalman filter on track centers, batched across
+    tracks. States are (N, 6) arrays of x, y, vx, vy, ax, ay with (N, 6, 6)
+    covariances, velocities in pixels per frame.
+    """
+
+    def __init__(self, measurement_std=5.0, acc_std=0.05):
+        self.H = np.zeros((2, 6))
+        self.H[0, 0] = self.H[1, 1] = 1
+        self.R = np.eye(2) * measurement_std**2
+        self.acc_var = acc_std**2
+        self.init_var = np.array([1, 1, 100, 100, 0.1, 0.1], dtype=np.float64) * measurement_std**2
+
+    def initiate(self, centers):
+        """
+        Return states and covariances of new tracks at <centers>
+        """
+        x = np.zeros((len(centers), 6))
+        x[:, :2] = centers
+        P = np.repeat(np.diag(self.init_var)[None], len(centers), axis=0)
+        return x, P
+
+    def _transition(self, dt):
+        F = np.eye(6)
+        F[0, 2] = F[1, 3] = F[2, 4] = F[3, 5] = dt
+        F[0, 4] = F[1, 5] = dt**2 / 2
+        # Piecewise constant white acceleration increments
+        g = np.array([dt**2 / 2, dt**2 / 2, dt, dt, 1, 1])
+        pair = np.array([0, 1, 0, 1, 0, 1])
+        Q = np.outer(g, g) * (pair[:, None] == pair[None, :]) * self.acc_var
+        return F, Q
+
+    def predict(self, x, P, dt=1.0):
+        """
+        Return states and covariances <dt> frames ahead
+        """
+        F, Q = self._transition(dt)
+        return x @ F.T, F @ P @ F.T + Q
+
+    def update(self, x, P, z):
+        """
+        Return states and covariances corrected with measured centers <z>
+        """
+        S = self.H @ P @ self.H.T + self.R
+        K = P @ self.H.T @ np.linalg.inv(S)
+        y = z - x @ self.H.T
+        x = x + (K @ y[:, :, None])[:, :, 0]
+        P = (np.eye(6) - K @ self.H) @ P
+        return x, P
+
+    def gating_distance(self, x, P, z):
+        """
+        Return the (N, M) squared Mahalanobis distances between the
+        predicted centers of N tracks and M measured centers <z>
+        """
+        S_inv = np.linalg.inv(self.H @ P @ self.H.T + self.R)
+        d = z[None, :, :] - (x @ self.H.T)[:, None, :]
+        return np.einsum('nmi,nij,nmj->nm', d, S_inv, d)
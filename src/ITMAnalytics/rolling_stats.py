@@ -0,0 +1,150 @@
+"""
+Copyright 2022 Intel Corporation
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+    http://www.apache.org/licenses/LICENSE-2.0
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+import time
+import numpy as np
+from multiprocessing import shared_memory
+
+# Counts aggregated per period, the InfluxDB field names
+FIELDS = ('people_count', 'car_count', 'bicycle_count', 'near_miss', 'collision')
+OBJECT_FIELDS = 3
+# Resolution name: (seconds per period, periods kept)
+RESOLUTIONS = {'1m': (60, 24 * 60), '1h': (3600, 7 * 24)}
+
+
+class RollingStats:
+    """
+    Per channel counts of new objects and near miss/collision events per
+    minute and per hour, in fixed size ring buffers.
+    Rows hold the period index (time // period seconds) then FIELDS, so
+    readers can tell stale rows of previous laps.
+    Like Metrics, rings are allocated by start() in shared memory and
+    worker processes receive the object pickled. Only the process writing
+    InfluxDB updates them.
+    """
+
+    def __init__(self, num_ch):
+        self.num_ch = num_ch
+        self.rings = None
+        self._shm = None
+        self._init_writer()
+
+    def _init_writer(self):
+        # Writer state, local to the updating process
+        self.last = np.zeros((self.num_ch, len(FIELDS)))
+        self.current = {name: [None] * self.num_ch for name in RESOLUTIONS}
+
+    def _size(self):
+        return sum(self.num_ch * slots * (len(FIELDS) + 1) * 8 for _, slots in RESOLUTIONS.values())
+
+    def _attach(self, buf):
+        self.rings, offset = {}, 0
+        for name, (_, slots) in RESOLUTIONS.items():
+            shape = (self.num_ch, slots, len(FIELDS) + 1)
+            self.rings[name] = np.ndarray(shape, dtype=np.float64, buffer=buf, offset=offset)
+            offset += self.rings[name].nbytes
+
+    def start(self, shared=True):
+        """
+        Allocate the rings, in shared memory if <shared>
+        """
+        if shared:
+            self._shm = shared_memory.SharedMemory(create=True, size=self._size())
+            self._attach(self._shm.buf)
+        else:
+            self._attach(bytearray(self._size()))
+        for ring in self.rings.values():
+            ring[:] = 0
+            ring[:, :, 0] = -1
+
+    def __getstate__(self):
+        return {'num_ch': self.num_ch, 'name': self._shm.name}
+
+    def __setstate__(self, state):
+        self.num_ch = state['num_ch']
+        self._shm = shared_memory.SharedMemory(name=state['name'])
+        self._attach(self._shm.buf)
+        self._init_writer()
+
+    def close(self):
+        if self._shm is not None:
+            self.rings = None
+            self._shm.close()
+
+    def unlink(self):
+        self._shm.unlink()
+
+    def update(self, ch_id, counts, now=None):
+        """
+        Add the increase of the cumulative <counts> (FIELDS order) of
+        channel <ch_id> since the last update to the current periods.
+        Counters going backwards restarted from 0.
+        Return the (resolution, period start, values) of the periods
+        completed since the last update.
+        """
+        now = time.time() if now is None else now
+        counts = np.asarray(counts, dtype=np.float64)
+        delta = counts - self.last[ch_id]
+        delta = np.where(delta < 0, counts, delta)
+        self.last[ch_id] = counts
+        completed = []
+        for name, (seconds, slots) in RESOLUTIONS.items():
+            ring = self.rings[name][ch_id]
+            period = int(now // seconds)
+            previous = self.current[name][ch_id]
+            if previous is not None and previous != period and ring[previous % slots, 0] == previous:
+                completed.append((name, previous * seconds, ring[previous % slots, 1:].copy()))
+            row = ring[period % slots]
+            if row[0] != period:
+                row[1:] = 0
+                row[0] = period
+            row[1:] += delta
+            self.current[name][ch_id] = period
+        return completed
+
+    def series(self, ch_id, name, periods, now=None):
+        """
+        Return the start times and (periods, FIELDS) values of the last
+        <periods> periods of resolution <name>, the current one last
+        """
+        seconds, slots = RESOLUTIONS[name]
+        period = int((time.time() if now is None else now) // seconds)
+        wanted = np.arange(period - min(periods, slots) + 1, period + 1)
+        rows = self.rings[name][ch_id][wanted % slots]
+        values = np.where((rows[:, 0] == wanted)[:, None], rows[:, 1:], 0)
+        return wanted * seconds, values
+
+    def summary(self, ch_id, minutes=60, hours=24, now=None):
+        """
+        Return the per minute and per hour series of channel <ch_id> with
+        their flow (objects per minute) and event rates (per hour), as a
+        JSON serializable dict
+        """
+        now = time.time() if now is None else now
+        result = {}
+        for name, periods in (('1m', minutes), ('1h', hours)):
+            seconds = RESOLUTIONS[name][0]
+            starts, values = self.series(ch_id, name, periods, now)
+            # The current period is partial
+            elapsed = np.full(len(starts), float(seconds))
+            elapsed[-1] = max(now - starts[-1], 1)
+            flow = values[:, :OBJECT_FIELDS].sum(axis=1) * 60 / elapsed
+            rows = []
+            for start, row, rate, span in zip(starts.tolist(), values.tolist(), flow.tolist(), elapsed.tolist()):
+                entry = dict(zip(FIELDS, (int(value) for value in row)))
+                entry['time'] = start
+                entry['flow_per_minute'] = round(rate, 3)
+                entry['near_miss_per_hour'] = round(entry['near_miss'] * 3600 / span, 3)
+                entry['collision_per_hour'] = round(entry['collision'] * 3600 / span, 3)
+                rows.append(entry)
+            result[name] = rows
+        return result
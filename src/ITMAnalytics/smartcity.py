@@ -11,58 +11,176 @@ See the License for the specific language governing permissions and
 limitations under the License.
 """
 
+import collections
 import cv2
 import sys
 import threading
 import time
 import yolo_labels
+from common.util import metrics as prom
+from common.util import trace
 from common.util.logger import get_logger
 from frame_utils import Frame
-from tracker import TrackingSystem, InfluxDB
+from tracker import TrackingSystem, InfluxDB, InfluxDBReporter
 from utils import Rect
 
 log = get_logger(__name__)
 
-tracking_system = []
+tracking_system = {}
 TRACKING = True
 COLLISION = True
+LAZY_RENDER = False
+# Stages of frame_callback timed in itm_analytics_stage_seconds, 'frame'
+# covers the whole callback
+STAGES = ('parse', 'tracking', 'render', 'format', 'publish', 'frame')
+stage_metrics = {}
+# Hops observed by the analytics tracer: frames arrive from inference
+TRACE_HOPS = ('inference', 'analytics')
+tracer = None
 
 
 class FpsManager:
     """
     Class to calculate FPS for each stream
     """
+    # Seconds of frames averaged
+    WINDOW = 5
+
     def __init__(self, num_ch):
         self.num_ch = num_ch
-        self.st_time = [0]*num_ch
-        self.frame_counts = [0]*num_ch
+        self.frame_times = [collections.deque() for _ in range(num_ch)]
 
     def update_ch(self, ch_id):
         """
-        Update and return average FPS for channel <ch_id>
-        Average FPS is used because it is stable and don't fluctuate.
+        Update and return FPS for channel <ch_id>
+        FPS is averaged over the last WINDOW seconds, stable enough to read
+        while still showing slowdowns.
         """
-        if self.st_time[ch_id] == 0:
-            self.st_time[ch_id] = time.monotonic()
-
-        self.frame_counts[ch_id] += 1
         t = time.monotonic()
-        fps = round(self.frame_counts[ch_id]/(t - self.st_time[ch_id]), 2)
-        return fps
+        frame_times = self.frame_times[ch_id]
+        frame_times.append(t)
+        while t - frame_times[0] > self.WINDOW:
+            frame_times.popleft()
+        if len(frame_times) < 2:
+            return 0
+        return round((len(frame_times) - 1)/(t - frame_times[0]), 2)
 
-import timeit
 
-def frame_callback(frame, conf_data, fps_manager, ch_id, q_data, running, cam_config, publish_queue):
-    #log.info(repr(frame['metadata']))
-    #log.info(ch_id)
-    t0 = timeit.default_timer()
-    fps = fps_manager.update_ch(ch_id)
+class StageTimer:
+    """
+    Observe the time between consecutive marks in the stage histograms
+    of a channel
+    """
+    def __init__(self, histograms):
+        self.histograms = histograms
+        self.start = self.last = time.perf_counter()
+
+    def mark(self, stage):
+        t = time.perf_counter()
+        self.histograms[stage].observe(t - self.last)
+        self.last = t
+
+    def done(self):
+        self.histograms['frame'].observe(time.perf_counter() - self.start)
+
+
+def declare_metrics(metrics, num_ch):
+    """
+    Declare the analytics series of <num_ch> channels in <metrics>
+    """
+    for ch_id in range(num_ch):
+        for stage in STAGES:
+            metrics.declare(prom.HISTOGRAM, 'itm_analytics_stage_seconds',
+                            'Time spent per frame in each analytics stage, the frame stage rate is the FPS',
+                            channel=ch_id, stage=stage)
+        metrics.declare(prom.COUNTER, 'itm_analytics_frames_skipped_total',
+                        'Frames forwarded without analytics under load', channel=ch_id)
+        metrics.declare(prom.GAUGE, 'itm_analytics_frame_skip',
+                        'Analytics run on 1 frame in this many', channel=ch_id)
+        for queue in ('frames', 'streams'):
+            metrics.declare(prom.GAUGE, 'itm_analytics_queue_depth',
+                            'Items waiting in a queue', queue=queue, channel=ch_id)
+            metrics.declare(prom.COUNTER, 'itm_analytics_queue_dropped_total',
+                            'Items dropped by a queue', queue=queue, channel=ch_id)
+    trace.declare(metrics, 'analytics', [ch_id + 1 for ch_id in range(num_ch)], TRACE_HOPS)
+    metrics.declare(prom.GAUGE, 'itm_analytics_queue_depth',
+                    'Items waiting in a queue', queue='publish')
+    metrics.declare(prom.COUNTER, 'itm_analytics_queue_dropped_total',
+                    'Items dropped by a queue', queue='publish')
+
+
+class FrameSkipper:
+    """
+    Per channel load shedding: only 1 frame in k is fully processed, the
+    others are forwarded unannotated. k grows while the input queue backs
+    up or full processing is slower than k frame intervals, and shrinks
+    once the channel has kept up for CALM_FRAMES frames.
+    """
+    CALM_FRAMES = 30
+    # Weight of the last sample in the processing time and interval averages
+    ALPHA = 0.1
+
+    def __init__(self, num_ch, max_skip):
+        self.max_skip = max_skip
+        self.k = [1]*num_ch
+        self.seen = [0]*num_ch
+        self.calm = [0]*num_ch
+        self.proc_time = [0]*num_ch
+        self.interval = [0]*num_ch
+        self.last_ts = [None]*num_ch
+        self.processed = [0]*num_ch
+        self.skipped = [0]*num_ch
+
+    def should_process(self, ch_id, backlog, queue_size, capture_ts=None):
+        """
+        Return whether the next frame of <ch_id> must be fully processed,
+        given the <backlog> of its input queue of <queue_size> frames.
+        """
+        if capture_ts is not None:
+            if self.last_ts[ch_id] is not None and capture_ts > self.last_ts[ch_id]:
+                self.interval[ch_id] += self.ALPHA*(capture_ts - self.last_ts[ch_id] - self.interval[ch_id])
+            self.last_ts[ch_id] = capture_ts
+        k, interval, proc_time = self.k[ch_id], self.interval[ch_id], self.proc_time[ch_id]
+        if backlog >= max(2, queue_size//2) or (interval and proc_time > k*interval):
+            self.calm[ch_id] = 0
+            if k < self.max_skip and self.seen[ch_id] % k == 0:
+                self._set_skip(ch_id, k + 1)
+        elif k > 1 and backlog <= 1 and (not interval or proc_time < 0.8*(k - 1)*interval):
+            self.calm[ch_id] += 1
+            if self.calm[ch_id] >= self.CALM_FRAMES:
+                self.calm[ch_id] = 0
+                self._set_skip(ch_id, k - 1)
+        process = self.seen[ch_id] % self.k[ch_id] == 0
+        self.seen[ch_id] += 1
+        if process:
+            self.processed[ch_id] += 1
+        else:
+            self.skipped[ch_id] += 1
+        return process
+
+    def _set_skip(self, ch_id, k):
+        log.info(f"camera{ch_id} processing 1 frame in {k}, {self.skip_rate(ch_id):.0%} skipped so far")
+        self.k[ch_id] = k
+        self.seen[ch_id] = 0
+
+    def update_time(self, ch_id, proc_time):
+        """
+        Account <proc_time> seconds spent fully processing a frame of <ch_id>
+        """
+        self.proc_time[ch_id] += self.ALPHA*(proc_time - self.proc_time[ch_id])
+
+    def skip_rate(self, ch_id):
+        """
+        Return the ratio of frames of <ch_id> skipped so far
+        """
+        total = self.processed[ch_id] + self.skipped[ch_id]
+        return self.skipped[ch_id]/total if total else 0
+
+def draw_fps(mat, fps):
+    """
+    Draw E2E FPS box on the top-left corner of <mat>
+    """
     scale, thickness, font = 0.6, 2, cv2.FONT_HERSHEY_SIMPLEX
-    first_results = []
-    frame_obj = Frame(frame)
-    width = frame_obj.width
-    height = frame_obj.height
-    mat = frame_obj.decode_frame(log)
     # TODO: add CPU/GPU to text ?
     text = "E2E FPS: {0}".format(fps)
     (text_width, text_height) = cv2.getTextSize(text, font, scale, thickness)[0]
@@ -70,8 +188,33 @@ def frame_callback(frame, conf_data, fps_manager, ch_id, q_data, running, cam_co
     box_coords = ((offset_x, offset_y), (offset_x + text_width + 2, offset_y - text_height - 2))
     cv2.rectangle(mat, box_coords[0], box_coords[1], (255, 255, 255), cv2.FILLED)
     cv2.putText(mat, text, (offset_x, offset_y), font, scale, (0, 0, 0), 1)
+
+
+def draw_detections(mat, results):
+    """
+    Draw labeled boxes of untracked detections
+    """
+    scale, thickness, font = 0.6, 2, cv2.FONT_HERSHEY_SIMPLEX
+    for rect, label in results:
+        cv2.rectangle(mat, (int(rect.x), int(rect.y)),
+                      (int(rect.x + rect.width), int(rect.y + rect.height)),
+                      (0, 255, 255), 2)
+        text = yolo_labels.get_label_str(label)
+        (text_width, text_height) = cv2.getTextSize(text, font, scale, thickness)[0]
+        box_coords = ((rect.x, rect.y), (rect.x + text_width + 2, rect.y - text_height - 2))
+        cv2.rectangle(mat, box_coords[0], box_coords[1], (0, 255, 255), cv2.FILLED)
+        cv2.putText(mat, text, (rect.x, rect.y), font, scale, (0, 0, 0), 1)
+
+
+def frame_callback(frame, conf_data, fps_manager, ch_id, q_data, running, cam_config, publish_queue,
+                   process=True):
+    timer = StageTimer(stage_metrics[ch_id])
+    fps = fps_manager.update_ch(ch_id)
+    first_results = []
+    frame_obj = Frame(frame)
+    width = frame_obj.width
+    height = frame_obj.height
     objects = {'ped': 0, 'bike': 0, 'car': 0}
-    t1 = timeit.default_timer()
     for roi in frame_obj.roi:
         if frame_obj.confidence_level(roi) < 0.5:
             continue
@@ -88,96 +231,138 @@ def frame_callback(frame, conf_data, fps_manager, ch_id, q_data, running, cam_co
             objects['bike'] += 1
         else:
             continue
-
-        if TRACKING:
-            first_results.append((rect, label))
-        else:
-            cv2.rectangle(mat, (int(rect.x), int(rect.y)),
-                          (int(rect.x + rect.width), int(rect.y + rect.height)),
-                          (0, 255, 255), 2)
-            text = yolo_labels.get_label_str(label)
-            (text_width, text_height) = cv2.getTextSize(text, font, scale, thickness)[0]
-            box_coords = ((rect.x, rect.y), (rect.x + text_width + 2, rect.y - text_height - 2))
-            cv2.rectangle(mat, box_coords[0], box_coords[1], (0, 255, 255), cv2.FILLED)
-            cv2.putText(mat, text, (rect.x, rect.y), font, scale, (0, 0, 0), 1)
-    t3 = timeit.default_timer()
+        first_results.append((rect, label))
+    timer.mark('parse')
     event = None
-    if TRACKING:
+    # Skipped frames leave the tracks alone, the time step of the next
+    # processed frame covers them
+    if TRACKING and process:
         if not tracking_system[ch_id].is_initialized:
             tracking_system[ch_id].init_tracker_system(width, height, first_results, len(conf_data))
-        tracking_system[ch_id].update_tracking_system(first_results)
-        tracking_success = tracking_system[ch_id].start_tracking()
-        if not tracking_success:
-            log.error('Tracking failed')
-            sys.exit(-1)
+        # Late frames are still published, with the current tracks
+        if tracking_system[ch_id].set_timestamp(frame_obj.capture_ts):
+            tracking_system[ch_id].update_tracking_system(first_results)
+            tracking_success = tracking_system[ch_id].start_tracking()
+            if not tracking_success:
+                log.error('Tracking failed')
+                sys.exit(-1)
         if tracking_system[ch_id].manager.tracker_vec != 0:
             if COLLISION and ('vehicle' in conf_data[ch_id]['analytics'] or 'bike' in conf_data[ch_id]['analytics']):
                 tracking_system[ch_id].detect_collision()
-            _, event = tracking_system[ch_id].draw_tracking_results(mat)
-    t4 = timeit.default_timer()
+            event = tracking_system[ch_id].get_event()
+    timer.mark('tracking')
     if not event:
         event = "none"
+
+    viewed = running[ch_id]
+    # With LAZY_RENDER, frames nobody watches and without events are
+    # forwarded with their original encoding, skipping decode, overlay
+    # drawing and encode.
+    img = None
+    if not process or (LAZY_RENDER and not viewed and event == "none"):
+        img = frame_obj.encoded_blob()
+    if img is None:
+        mat = frame_obj.decode_frame(log)
+        if process:
+            draw_fps(mat, fps)
+            if TRACKING:
+                tracking_system[ch_id].draw_tracking_results(mat)
+            else:
+                draw_detections(mat, first_results)
+        # Encoded once, shared by the publisher and all dashboard streams
+        img = memoryview(cv2.imencode('.jpg', mat)[1].reshape(-1))
+    timer.mark('render')
     frame = frame_obj.format_pub_frame(event, ch_id, cam_config[ch_id]['address'], objects)
-    t41 = timeit.default_timer()
 
     log.debug(f"publish frame {frame}")
-    frame['img'] = cv2.imencode('.jpg', mat)[1].tobytes()
-    t42 = timeit.default_timer()
+    frame['img'] = img
+    timer.mark('format')
 
+    trace.leave(frame)
+    tracer.observe(frame, ch_id + 1)
     #publish_queue.put(frame)
     publish_queue.append(frame)
-    t43 = timeit.default_timer()
 
     try:
-        if running[ch_id]:
+        if viewed and process:
             # if not q_data[ch_id].full():
             #     q_data[ch_id].put(mat, False)
             # else:
             #     _ = q_data[ch_id].get(False)
             #     q_data[ch_id].put(mat, False)
-            q_data[ch_id].append(mat)
+            # Only the JPEG goes to the streams, the raw frame would not fit
+            # in a ring slot from 720p on
+            q_data[ch_id].append({'img': img, trace.SEQ: frame.get(trace.SEQ),
+                                  trace.CAPTURE_TS: frame.get(trace.CAPTURE_TS)})
     except Exception:
         sys.exit()
-    # t44 = timeit.default_timer()
-    # log.info(f"camera{ch_id} ... {t41 - t4} format frame")
-    # log.info(f"camera{ch_id} ... {t42 - t41} encode frame")
-    # log.info(f"camera{ch_id} ... {t43 - t42} publish 1")
-    # log.info(f"camera{ch_id} ... {t44 - t43} publish2")
-    #
-    #
-    #
-    # t5 = timeit.default_timer()
-    # log.info(f"camera{ch_id} ... {t1 - t0} for frame init + text")
-    # log.info(f"camera{ch_id} ... {t3 - t1} for roi parse")
-    # log.info(f"camera{ch_id} ... {t4 - t3} for obj draw")
-    # log.info(f"camera{ch_id} ... {t5 - t4} for frame publish")
+    timer.mark('publish')
+    timer.done()
 
 
 def start_app(config_data, tracking, collision,
-              client, q_data, running, queue_dict, publish_queue):
+              client, q_data, running, queue_dict, publish_queue, lazy_render=False,
+              channels=None, influx_updates=None, tracker_engine='threaded',
+              motion_model='average', max_frame_skip=1, metrics=None, influx_options=None):
     """
     Main function to start smart city.
+    Runs analytics of <channels> (all by default). Worker processes pass
+    <influx_updates> to send their counts to the InfluxDB writer of the
+    main process instead of writing them.
+    <tracker_engine> selects the TrackingManager: 'threaded' or 'vector',
+    <motion_model> its kinematics: 'average' or 'kalman'.
+    Under load, channels fully process down to 1 frame in <max_frame_skip>.
+    Channel series declared by declare_metrics are updated in <metrics>.
+    <influx_options> are the keyword arguments of the InfluxDB writer.
     """
-    global TRACKING, COLLISION
+    global TRACKING, COLLISION, LAZY_RENDER, tracer
     log.info("Starting SmartCity")
-    TRACKING, COLLISION = tracking, collision
+    TRACKING, COLLISION, LAZY_RENDER = tracking, collision, lazy_render
     num_ch = len(queue_dict.keys())
-    log.info(f"{num_ch} channels")
-    log.info(f" tracking: {tracking}, collision: {collision}")
-    client = InfluxDB(client, num_ch, config_data)
+    channels = list(range(num_ch)) if channels is None else channels
+    log.info(f"{num_ch} channels, running {channels}")
+    log.info(f" tracking: {tracking} ({tracker_engine}, {motion_model}), collision: {collision}, lazy render: {lazy_render}")
+    if influx_updates is None:
+        client = InfluxDB(client, num_ch, config_data, **(influx_options or {}))
+    else:
+        client = InfluxDBReporter(influx_updates, num_ch, config_data, channels)
     client.start()
-    for i in range(num_ch):
-        tracking_system.append(TrackingSystem(i, client, config_data[i]))
+    if metrics is None:
+        metrics = prom.Metrics()
+        declare_metrics(metrics, num_ch)
+        metrics.start(shared=False)
+    tracer = trace.Tracer(metrics, 'analytics')
+    for i in channels:
+        stage_metrics[i] = {stage: metrics.get('itm_analytics_stage_seconds', channel=i, stage=stage)
+                            for stage in STAGES}
+        tracking_system[i] = TrackingSystem(i, client, config_data[i], tracker_engine, motion_model)
     log.info("Tracking system initialized")
     fps_manager = FpsManager(num_ch)
+    skipper = FrameSkipper(num_ch, max_frame_skip)
     def get_frame(queue, fps_manager, ch_id, q_data, running, config_data, publish_queue):
+        depth = metrics.get('itm_analytics_queue_depth', queue='frames', channel=ch_id)
+        dropped = metrics.get('itm_analytics_queue_dropped_total', queue='frames', channel=ch_id)
+        skipped = metrics.get('itm_analytics_frames_skipped_total', channel=ch_id)
+        frame_skip = metrics.get('itm_analytics_frame_skip', channel=ch_id)
         try:
             while True:
-                if queue:
-                    #log.info(f"frame.....camera{ch_id} ..." + str(queue.qsize()))
-                    frame_callback(queue.popleft(), config_data, fps_manager, ch_id, q_data, running,  config_data, publish_queue)
-                else:
-                    time.sleep(0.005)
+                try:
+                    frame = queue.popleft(block=True, timeout=1)
+                except IndexError:
+                    continue
+                trace.enter(frame, 'analytics')
+                backlog = len(queue)
+                process = skipper.should_process(ch_id, backlog, queue.slots, frame.get('capture_ts'))
+                depth.set(backlog)
+                dropped.set(queue.dropped + queue.lapped)
+                frame_skip.set(skipper.k[ch_id])
+                if not process:
+                    skipped.inc()
+                st_time = time.monotonic()
+                frame_callback(frame, config_data, fps_manager, ch_id, q_data, running,  config_data, publish_queue,
+                               process)
+                if process:
+                    skipper.update_time(ch_id, time.monotonic() - st_time)
         except KeyboardInterrupt:
             log.info('Quitting...')
             client.stop()
@@ -186,13 +371,14 @@ def start_app(config_data, tracking, collision,
             client.stop()
 
     analytics_threads = []
-    for i in range(0, num_ch):
-        log.info("Preparing analytics thread for topic: " + list(queue_dict.keys())[i])
+    topics = list(queue_dict.keys())
+    for i in channels:
+        log.info("Preparing analytics thread for topic: " + topics[i])
         analytics_threads.append(threading.Thread(target=get_frame,
-                                                  args=(queue_dict[list(queue_dict.keys())[i]], fps_manager, i, q_data, running, config_data, publish_queue)))
+                                                  args=(queue_dict[topics[i]], fps_manager, i, q_data, running, config_data, publish_queue)))
         log.info("Starting thread")
-        analytics_threads[i].start()
+        analytics_threads[-1].start()
 
-    for i in range(0, num_ch):
-        analytics_threads[i].join()
+    for thread in analytics_threads:
+        thread.join()
     client.stop()
@@ -17,26 +17,43 @@ import math
 import collections
 from threading import Thread
 import cv2
+import numpy as np
 import yolo_labels
+from influx_writer import InfluxWriter, line
+from rolling_stats import FIELDS as STATS_FIELDS
+from association import NEW_TRACK, NO_LABEL, NO_TRACK, associate, overlapping_pairs, rect_array
+from motion import GATING_THRESHOLD, MOTION_AVERAGE, MOTION_KALMAN, KalmanModel
 from utils import Point, Rect
+from vector_tracker import VectorTrackingManager
 import logging
 log = logging.getLogger(__name__)
 logging.basicConfig(level=logging.INFO,
                     format="%(asctime)s :: %(message)s")
 
+# Rates are per reference frame, the frame interval of the video pipeline,
+# so thresholds tuned on frame counts keep their meaning at any frame rate
+REFERENCE_FPS = 30
+# Bounds of the time step between two processed frames, in reference frames
+MIN_DT, MAX_DT = 0.1, 10
+# Near misses are not evaluated across larger gaps
+MAX_COLLISION_DT = 4
+
 
 class SingleTracker:
 
     # If detecting to many false collisions, try decreasing ACC_FACTOR
     ACC_FACTOR = 1000
 
-    def __init__(self, id, rect, color, label, influx_client=None):
+    def __init__(self, id, rect, color, label, influx_client=None, motion_model=None):
         self.id = id
         self.rect = rect
         self.color = color
         self.label = label
         self.c_q = collections.deque(maxlen=5)
         self.avg_pos = collections.deque(maxlen=50)
+        # Clock of the entries of c_q, avg_pos and v_q, in reference frames
+        self.clock = 0
+        self.c_t, self.avg_t, self.v_t = collections.deque(maxlen=5), collections.deque(maxlen=50), collections.deque(maxlen=50)
         self.center = self.rect.center()
         self.vel, self.acc = Point(0, 0), Point(0, 0)
         self.vel_x, self.vel_y = 0, 0
@@ -51,6 +68,10 @@ class SingleTracker:
         self.collision = 0
         self.rect_width = 0
         self.influx_client = influx_client
+        # Optional KalmanModel replacing the moving average kinematics
+        self.motion_model = motion_model
+        if motion_model:
+            self.kf_x, self.kf_P = motion_model.initiate([[self.center.x, self.center.y]])
 
     def _set_vel(self, vel):
         self.vel = vel
@@ -86,39 +107,43 @@ class SingleTracker:
                 avg += self.c_q[i]
             avg /= full
             self.avg_pos.appendleft(avg)
+            self.avg_t.appendleft(sum(self.c_t)/full)
 
     def cal_vel(self):
         """
-        Calculate velocity as an average of last n_frames frames (dX, dY).
+        Calculate velocity as an average of last n_frames frames (dX/dt, dY/dt).
         """
         full = 5
         delta_x, delta_y = 0, 0
         limit = min(full, len(self.avg_pos) -1)
         if limit > 1:
             for i in range(0, limit):
-                delta_x += self.avg_pos[i].x - self.avg_pos[i+1].x
-                delta_y += self.avg_pos[i].y - self.avg_pos[i+1].y
+                elapsed = self.avg_t[i] - self.avg_t[i+1]
+                delta_x += (self.avg_pos[i].x - self.avg_pos[i+1].x)/elapsed
+                delta_y += (self.avg_pos[i].y - self.avg_pos[i+1].y)/elapsed
             delta_x /= limit
             delta_y /= limit
             avg_vel = Point(delta_x, delta_y)
             self._set_vel(self.center + avg_vel)
             self._save_last_vel(self.vel_x, self.vel_y, self.mod_vel)
+            self.v_t.appendleft(self.avg_t[0])
         else:
             self._set_vel(self.center)
 
     def cal_acc(self):
         """
-        Calculate acceleration as an average of last n_frames frames (dX, dY).
+        Calculate acceleration as an average of last n_frames frames (dVX/dt, dVY/dt).
         """
         full = 5
         delta_x, delta_y = 0, 0
         limit = min(full, len(self.v_q) -1)
         if limit > 1:
             for i in range(0, limit):
-                delta_x += (self.v_x_q[i]+1)*SingleTracker.ACC_FACTOR/(self.avg_pos[i].y+10) - \
-                           (self.v_x_q[i+1]+1)*SingleTracker.ACC_FACTOR/(self.avg_pos[i].y+10)
-                delta_y += (self.v_y_q[i]+1)*SingleTracker.ACC_FACTOR/(self.avg_pos[i].y+10) - \
-                           (self.v_y_q[i+1]+1)*SingleTracker.ACC_FACTOR/(self.avg_pos[i].y+10)
+                elapsed = self.v_t[i] - self.v_t[i+1]
+                delta_x += ((self.v_x_q[i]+1)*SingleTracker.ACC_FACTOR/(self.avg_pos[i].y+10) - \
+                            (self.v_x_q[i+1]+1)*SingleTracker.ACC_FACTOR/(self.avg_pos[i].y+10))/elapsed
+                delta_y += ((self.v_y_q[i]+1)*SingleTracker.ACC_FACTOR/(self.avg_pos[i].y+10) - \
+                            (self.v_y_q[i+1]+1)*SingleTracker.ACC_FACTOR/(self.avg_pos[i].y+10))/elapsed
             delta_x /= limit
             delta_y /= limit
             acc = Point(delta_x, delta_y)
@@ -147,21 +172,50 @@ class SingleTracker:
             self.to_delete = True
         return True
 
-    def do_single_tracking(self):
+    def do_kalman_tracking(self, dt):
         """
-        Track 'one' target specified by SingleTracker.rect in a frame.
+        Track 'one' target with the Kalman filter motion model.
         """
+        self.kf_x, self.kf_P = self.motion_model.predict(self.kf_x, self.kf_P, dt)
+        if self.update:
+            self.kf_x, self.kf_P = self.motion_model.update(
+                self.kf_x, self.kf_P, np.array([[self.center.x, self.center.y]]))
+        self.update = False
+        x, y, vx, vy, ax, ay = self.kf_x[0].tolist()
+        self.rect.x = x - self.rect.width/2
+        self.rect.y = y - self.rect.height/2
+        self.center = Point(x, y)
+        self.c_q.appendleft(self.center)
+        self.avg_pos.appendleft(self.center)
+        self._set_vel(self.center + Point(vx, vy))
+        self._save_last_vel(self.vel_x, self.vel_y, self.mod_vel)
+        scale = SingleTracker.ACC_FACTOR/(y+10)
+        self._set_acc(self.center + Point(ax*scale, ay*scale))
+        self._save_last_acc(self.acc_x, self.acc_y, self.mod_acc)
+        self.no_update_counter += dt
+        self.mark_for_deletion()
+        return True
+
+    def do_single_tracking(self, dt=1):
+        """
+        Track 'one' target specified by SingleTracker.rect in a frame,
+        <dt> reference frames after the previous one.
+        """
+        self.clock += dt
+        if self.motion_model:
+            return self.do_kalman_tracking(dt)
         if not self.update:
             self.center = Point(self.vel.x, self.vel.y)
-            self.rect.x += self.vel_x
-            self.rect.y += self.vel_y
+            self.rect.x += self.vel_x*dt
+            self.rect.y += self.vel_y*dt
         self.update = False
         self.center = self.rect.center()
         self.c_q.appendleft(self.center)
+        self.c_t.appendleft(self.clock)
         self.cal_avg_pos()
         self.cal_vel()
         self.cal_acc()
-        self.no_update_counter += 1
+        self.no_update_counter += dt
         self.mark_for_deletion()
         return True
 
@@ -172,8 +226,11 @@ class TrackingManager:
     total_bicycle_count = 0
     total_people_count = 0
 
-    def __init__(self, channel_id=None, influx_client=None):
+    def __init__(self, channel_id=None, influx_client=None, motion_model=MOTION_AVERAGE):
         self.channel_id = channel_id
+        self.motion_model = KalmanModel() if motion_model == MOTION_KALMAN else None
+        # Time elapsed since the previous frame (see TrackingSystem.set_timestamp)
+        self.dt = 1
         self.tracker_vec = []
         self.id_list = 0
         self.people_count = 0
@@ -201,7 +258,8 @@ class TrackingManager:
                     self.tracker_vec[result_idx].label = _label
                     self.tracker_vec[result_idx].color = _color
         else:
-            new_tracker = SingleTracker(_target_id, _init_rect, _color, _label, self.influx_client)
+            new_tracker = SingleTracker(_target_id, _init_rect, _color, _label, self.influx_client,
+                                        self.motion_model)
             self.tracker_vec.append(new_tracker)
             self.id_list = _target_id + 1
             if _label == 1:
@@ -255,6 +313,26 @@ class TrackingManager:
             index = best.id
         return index
 
+    def associate(self, detections):
+        """
+        Match list of (rect, label) <detections> to SingleTracker objects at once.
+        Return the tracker ID of each detection, NEW_TRACK or NO_TRACK.
+        """
+        labels = [NO_LABEL if t.label is None else t.label for t in self.tracker_vec]
+        track_rects = rect_array([t.rect for t in self.tracker_vec])
+        det_rects = rect_array([d[0] for d in detections])
+        gating = None
+        if self.motion_model and self.tracker_vec:
+            # Match against the predicted positions, within their uncertainty
+            x, P = self.motion_model.predict(np.concatenate([t.kf_x for t in self.tracker_vec]),
+                                             np.concatenate([t.kf_P for t in self.tracker_vec]), self.dt)
+            track_rects[:, :2] = x[:, :2] - track_rects[:, 2:] / 2
+            det_centers = det_rects[:, :2] + det_rects[:, 2:] / 2
+            gating = self.motion_model.gating_distance(x, P, det_centers) < GATING_THRESHOLD
+        rows = associate(track_rects, np.array(labels, dtype=np.int64), det_rects,
+                         np.array([d[1] for d in detections], dtype=np.int64), gating)
+        return [self.tracker_vec[row].id if row >= 0 else int(row) for row in rows]
+
     def delete_tracker(self, _target_id):
         """
         Delete SingleTracker object which has ID : _target_id in the TrackerManager.tracker_vec
@@ -274,19 +352,81 @@ class TrackingManager:
                 TrackingManager.total_vehicle_count,
                 TrackingManager.total_bicycle_count]
 
+    def track_all(self, frame_width, frame_height):
+        """
+        Track all targets, one thread per SingleTracker, and delete the
+        targets out of the frame or lost.
+        """
+        thread_pool = []
+        for ptr in self.tracker_vec:
+            thread = Thread(target=ptr.do_single_tracking,
+                            args=(self.dt,))
+            thread_pool.append(thread)
+            thread.start()
+        for thread in thread_pool:
+            thread.join()
+        tracker_erase = []
+        for tracker in self.tracker_vec:
+            if not tracker.is_target_in_frame(frame_width, frame_height) or tracker.to_delete:
+                tracker_erase.append(tracker.id)
+        for tr in tracker_erase:
+            self.delete_tracker(tr)
+        return True
+
+    def clear(self):
+        """
+        Remove all trackers
+        """
+        self.tracker_vec = []
+
+
+# Tracking engines selectable with the tracker_engine setting
+TRACKER_ENGINES = {
+    'threaded': TrackingManager,
+    'vector': VectorTrackingManager,
+}
+
+
+# Measurements written by InfluxDB: 'legacy' has a measurement per channel
+# and collision fields per channel, 'tagged' the counts and collisions
+# measurements tagged by channel, 'dual' writes both while dashboards
+# migrate
+SCHEMA_LEGACY = 'legacy'
+SCHEMA_TAGGED = 'tagged'
+SCHEMA_DUAL = 'dual'
+# Event timestamps remembered to keep events of the same series apart
+EVENT_HISTORY = 1024
+
 
 class InfluxDB:
     """
     Class to push data to InfluxDB periodically
+    Counts are sampled every second and handed, timestamped, to an
+    InfluxWriter configured with <writer_options>.
+    Collision events are (timestamp, channel, details) tuples. Events of
+    the same series and capture time would overwrite each other, so later
+    ones are moved 1 ns forward.
+    <schema> selects the measurements written, tagged ones carry the
+    <node> name.
+    With RollingStats <stats>, counts are also aggregated per minute and
+    per hour, and each completed period is written to the stats_1m and
+    stats_1h measurements.
     """
-    def __init__(self, influxdb, num_ch, config_data):
+    def __init__(self, influxdb, num_ch, config_data, writer_options=None, schema=SCHEMA_LEGACY, node='',
+                 stats=None):
         self.influxdb = influxdb
+        self.schema = schema
+        self.node = node
+        self.stats = stats
+        self.writer = InfluxWriter(influxdb, **(writer_options or {})) if influxdb is not None else None
         self.data = [0]*num_ch
         self.total_counts = []
         self.total_collision_count = 0
         self.near_miss_count = [0]*num_ch
         self.collision_count = [0]*num_ch
-        self.collision_events = []
+        self.collision_events = collections.deque()
+        # (series, timestamp) of the last EVENT_HISTORY events written
+        self._event_times = collections.OrderedDict()
         self.num_ch = num_ch
         self.config_data = config_data
         self.running = False
@@ -295,6 +435,8 @@ class InfluxDB:
         """
         Start Thread
         """
+        if self.writer is not None:
+            self.writer.start()
         self.th = Thread(target=self.update_db, args=())
         self.running = True
         self.th.daemon = True
@@ -306,6 +448,31 @@ class InfluxDB:
         """
         self.running = False
         self.th.join()
+        if self.writer is not None:
+            self.writer.stop()
+
+    def listen(self, updates):
+        """
+        Start Thread merging counts sent by InfluxDBReporter objects
+        """
+        self.listener = Thread(target=self._merge_updates, args=(updates,))
+        self.listener.daemon = True
+        self.listener.start()
+
+    def _merge_updates(self, updates):
+        while True:
+            update = updates.get()
+            for ch_id, counts in update['data'].items():
+                self.data[ch_id] = counts
+            for ch_id, count in update['near_miss_count'].items():
+                self.near_miss_count[ch_id] = count
+            for ch_id, count in update['collision_count'].items():
+                self.collision_count[ch_id] = count
+            self.collision_events.extend(update['collision_events'])
+            # Totals of each reporter only cover its own channels
+            counts = [ch_data for ch_data in self.data if ch_data != 0]
+            if counts:
+                self.total_counts = [sum(column) for column in zip(*counts)]
 
     def update_db(self):
         """
@@ -313,50 +480,139 @@ class InfluxDB:
         """
         while self.running:
             time.sleep(1)
-            json_body = []
-            for ch_id, ch_data in enumerate(self.data):
-                # log.info(self.config_data)
-                if ch_data != 0:
-                    json_body.append({'measurement': f'channel{ch_id}',
-                                      'fields': {'people_count': ch_data[0],
-                                                 'car_count': ch_data[1],
-                                                 'bicycle_count': ch_data[2]}
-                                     })
-                if self.near_miss_count[ch_id] != 0 or self.collision_count[ch_id] != 0:
-                    json_body.append({'measurement': "collisions_data",
-                                      'fields': {f'channel{ch_id}near miss': self.near_miss_count[ch_id],
-                                                 f'channel{ch_id}collision': self.collision_count[ch_id]}
-                                    })
-
-
-            if self.total_counts:
-                json_body.append({'measurement': 'total_count',
-                                  'fields': {'total_people_count': self.total_counts[0],
-                                             'total_car_count': self.total_counts[1],
-                                             'total_bicycle_count': self.total_counts[2]}
-                                })
-
+            now = time.time_ns()
+            events = []
+            while self.collision_events:
+                events.append(self.collision_events.popleft())
             self.total_collision_count = sum(self.collision_count)
-            if self.total_collision_count:
-                json_body.append({'measurement': 'total_count',
-                                  'fields': {'total_collision_count': self.total_collision_count}
-                                })
+            points = []
+            if self.schema != SCHEMA_TAGGED:
+                points.extend(self._legacy_points(now, events))
+            if self.schema != SCHEMA_LEGACY:
+                points.extend(self._tagged_points(now, events))
+            if self.stats is not None:
+                points.extend(self._stats_points(now))
+            if points:
+                self.writer.write(points)
+
+    def _legacy_points(self, now, events):
+        """
+        Points of a measurement per channel, with collisions as fields
+        per channel
+        """
+        points = []
+        for ch_id, ch_data in enumerate(self.data):
+            # log.info(self.config_data)
+            if ch_data != 0:
+                points.append(line(f'channel{ch_id}',
+                                   {'people_count': ch_data[0],
+                                    'car_count': ch_data[1],
+                                    'bicycle_count': ch_data[2]}, timestamp=now))
+            if self.near_miss_count[ch_id] != 0 or self.collision_count[ch_id] != 0:
+                points.append(line("collisions_data",
+                                   {f'channel{ch_id}near miss': self.near_miss_count[ch_id],
+                                    f'channel{ch_id}collision': self.collision_count[ch_id]}, timestamp=now))
+
+
+        if self.total_counts:
+            points.append(line('total_count',
+                               {'total_people_count': self.total_counts[0],
+                                'total_car_count': self.total_counts[1],
+                                'total_bicycle_count': self.total_counts[2]}, timestamp=now))
+
+        if self.total_collision_count:
+            points.append(line('total_count',
+                               {'total_collision_count': self.total_collision_count}, timestamp=now))
+
+        for timestamp, _, event in events:
+            points.append(line("collisions_event", {'details': event},
+                               timestamp=self._event_ns("collisions_event", timestamp)))
+        return points
+
+    def _tagged_points(self, now, events):
+        """
+        Points of the counts and collisions measurements, tagged by node,
+        channel and address so cross camera queries need no fan out
+        """
+        points = []
+        for ch_id, ch_data in enumerate(self.data):
+            tags = self._tags(ch_id)
+            if ch_data != 0:
+                points.append(line('counts', {'people_count': ch_data[0],
+                                              'car_count': ch_data[1],
+                                              'bicycle_count': ch_data[2]}, tags, now))
+            if self.near_miss_count[ch_id] != 0 or self.collision_count[ch_id] != 0:
+                points.append(line('collisions', {'near_miss': self.near_miss_count[ch_id],
+                                                  'collision': self.collision_count[ch_id]}, tags, now))
+        for timestamp, ch_id, event in events:
+            points.append(line('collisions', {'details': event}, self._tags(ch_id),
+                               self._event_ns(('collisions', ch_id), timestamp)))
+        return points
+
+    def _event_ns(self, series, timestamp):
+        """
+        Return <timestamp> in nanoseconds, moved forward past the events of
+        <series> already written at that time
+        """
+        ns = int(timestamp * 1e9)
+        while (series, ns) in self._event_times:
+            ns += 1
+        self._event_times[(series, ns)] = None
+        if len(self._event_times) > EVENT_HISTORY:
+            self._event_times.popitem(last=False)
+        return ns
+
+    def _stats_points(self, now):
+        """
+        Update the rolling stats, return the points of completed periods
+        """
+        points = []
+        for ch_id, ch_data in enumerate(self.data):
+            counts = list(ch_data) if ch_data != 0 else [0, 0, 0]
+            counts += [self.near_miss_count[ch_id], self.collision_count[ch_id]]
+            for name, start, values in self.stats.update(ch_id, counts, now / 1e9):
+                points.append(line(f'stats_{name}', dict(zip(STATS_FIELDS, (int(v) for v in values))),
+                                   self._tags(ch_id), start * 10**9))
+        return points
+
+    def _tags(self, ch_id):
+        return {'node': self.node, 'channel': ch_id, 'address': self.config_data[ch_id]['address']}
+
+
+class InfluxDBReporter(InfluxDB):
+    """
+    Stand-in for InfluxDB in analytics worker processes.
+    Counts of <channels> are sent every second to the InfluxDB object of
+    the main process, which writes them.
+    """
+    def __init__(self, updates, num_ch, config_data, channels):
+        super().__init__(None, num_ch, config_data)
+        self.updates = updates
+        self.channels = channels
 
+    def update_db(self):
+        """
+        Send channel counts to the writer in every 1 second
+        """
+        while self.running:
+            time.sleep(1)
+            events = []
             while self.collision_events:
-                event = self.collision_events.pop(0)
-                json_body.append({'measurement': "collisions_event",
-                                  'fields': {f'details': event}
-                                })
-            #print(repr(json_body))
-            if json_body:
-               self.influxdb.write_points(json_body)
+                events.append(self.collision_events.popleft())
+            self.updates.put({
+                'data': {ch_id: self.data[ch_id] for ch_id in self.channels if self.data[ch_id] != 0},
+                'near_miss_count': {ch_id: self.near_miss_count[ch_id] for ch_id in self.channels},
+                'collision_count': {ch_id: self.collision_count[ch_id] for ch_id in self.channels},
+                'collision_events': events
+            })
 
 
 class TrackingSystem:
 
     total_collision_count = 0
 
-    def __init__(self, channel_id=None, influx_client=None, cam_config=[]):
+    def __init__(self, channel_id=None, influx_client=None, cam_config=[], engine='threaded',
+                 motion_model=MOTION_AVERAGE):
         self.channel_id = channel_id
         self.frame_width = None
         self.frame_height = None
@@ -364,7 +620,7 @@ class TrackingSystem:
         self.init_target = {Rect(0, 0, 0, 0), 0}
         self.updated_target = {Rect(0, 0, 0, 0), 0}
         self.cam_config = cam_config
-        self.manager = TrackingManager(channel_id, influx_client)
+        self.manager = TRACKER_ENGINES[engine](channel_id, influx_client, motion_model)
         self.is_initialized = False
         self.total_frames = 0
         self.influx_client = influx_client
@@ -375,7 +631,10 @@ class TrackingSystem:
         self.buffer_tracker = []
         self.n_obj1 = 0
         self.n_obj2 = 0
-        self.collision_couples = []
+        # (ID, ID) pairs of trackers already counted as a collision
+        self.collision_couples = set()
+        self.last_timestamp = None
+        self.dt = 1
 
 
     def init_tracker_system(self, frame_width, frame_height, init_target, num_channels):
@@ -408,20 +667,42 @@ class TrackingSystem:
         Insert new multiple SingleTracker objects to the manager.tracker_vec.
         If you want multi-object tracking, call this function just for once like.
         """
-        label, color = None, None
-        for target in updated_results:
+        targets = [target for target in updated_results
+                   if not (target[0].area()/(self.frame_width*self.frame_height) < 0.009 and
+                           target[1] == yolo_labels.LABEL_CAR)]
+        # All detections are matched at once, so two of them can't claim the same tracker
+        matches = self.manager.associate(targets)
+        for target, index in zip(targets, matches):
+            if index == NO_TRACK:
+                continue
+            if index == NEW_TRACK:
+                index = self.manager.id_list
             label = target[1]
             color = yolo_labels.get_label_color(label)
-            if target[0].area()/(self.frame_width*self.frame_height) < 0.009 and label == yolo_labels.LABEL_CAR:
-                continue
-            index = self.manager.find_tracker(target[0], label)
-            if index != -1:
-                counts = self.manager.insert_tracker_by_id(target[0], color, index, label, True)
-                if counts and self.influx_client:
-                    self.influx_client.data[self.channel_id] = counts
-                    self.influx_client.total_counts = self.manager.get_total_counts()
-                elif counts is False:
-                    return False
+            counts = self.manager.insert_tracker_by_id(target[0], color, index, label, True)
+            if counts and self.influx_client:
+                self.influx_client.data[self.channel_id] = counts
+                self.influx_client.total_counts = self.manager.get_total_counts()
+            elif counts is False:
+                return False
+        return True
+
+    def set_timestamp(self, timestamp):
+        """
+        Set the capture <timestamp> (seconds) of the next frame to track.
+        The time step from the previous frame, in reference frames, is
+        passed to the manager. Frames without timestamp are 1 reference
+        frame apart. Return False for frames older than the previous one,
+        which must not be tracked.
+        """
+        dt = 1
+        if timestamp is not None and self.last_timestamp is not None:
+            if timestamp <= self.last_timestamp:
+                return False
+            dt = min(max((timestamp - self.last_timestamp)*REFERENCE_FPS, MIN_DT), MAX_DT)
+        if timestamp is not None:
+            self.last_timestamp = timestamp
+        self.dt = self.manager.dt = dt
         return True
 
     def start_tracking(self):
@@ -430,21 +711,19 @@ class TrackingSystem:
         You don't need to give target id for tracking.
         This function will track all targets.
         """
-        thread_pool = []
-        for ptr in self.manager.tracker_vec:
-            thread = Thread(target=ptr.do_single_tracking,
-                            args=())
-            thread_pool.append(thread)
-            thread.start()
-        for thread in thread_pool:
-            thread.join()
-        tracker_erase = []
+        return self.manager.track_all(self.frame_width, self.frame_height)
+
+    def get_event(self):
+        """
+        Return the event to report for the current frame, if any.
+        """
+        event = None
         for tracker in self.manager.tracker_vec:
-            if not tracker.is_target_in_frame(self.frame_width, self.frame_height) or tracker.to_delete:
-                tracker_erase.append(tracker.id)
-        for tr in tracker_erase:
-            self.manager.delete_tracker(tr)
-        return True
+            if tracker.collision:
+                event = "collision"
+            elif tracker.near_miss:
+                event = "near_miss"
+        return event
 
     def draw_tracking_results(self, mat):
         """
@@ -497,21 +776,24 @@ class TrackingSystem:
         """
         Detect collision and near miss between all trackers
         """
-        if not self.manager.tracker_vec:
+        trackers = self.manager.tracker_vec
+        if not trackers:
             return False
-        to_del = []
-        for couple in self.collision_couples:
-            to_find = int(couple.split(":")[0])
-            found = False
-            for tracker in self.manager.tracker_vec:
-                if to_find == tracker.id:
-                    found = True
-            if not found:
-                to_del.append(couple)
-        for del_couple in to_del:
-            self.collision_couples.remove(del_couple)
+        # Couples expire with their first tracker
+        live = {tracker.id for tracker in trackers}
+        self.collision_couples = {couple for couple in self.collision_couples if couple[0] in live}
+        # Accelerations across a long gap are not reliable
+        if self.dt > MAX_COLLISION_DT:
+            self.total_frames += 1
+            return True
 
-        for tracker in self.manager.tracker_vec:
+        # Broad phase: only overlapping trackers are tested against each other
+        overlapping = [[] for _ in trackers]
+        for i, j in zip(*(idx.tolist() for idx in overlapping_pairs(rect_array([t.rect for t in trackers])))):
+            overlapping[i].append(j)
+            overlapping[j].append(i)
+
+        for index, tracker in enumerate(trackers):
             if tracker.label == yolo_labels.LABEL_PERSON:
                 continue
             v_x_q = tracker.v_x_q.copy()
@@ -549,36 +831,36 @@ class TrackingSystem:
                 if self.influx_client is not None and not tracker.near_miss:
                     pass
                 tracker.near_miss =  True
-                for other_tracker in self.manager.tracker_vec:
-                    if tracker.id == other_tracker.id:
-                        continue
-                    if tracker.rect.intersect(other_tracker.rect).area() > 0:
-                        tracker.rect_width = 2
-                        other_tracker.rect_width = 2
-                        if tracker.id < other_tracker.id:
-                            obj1, obj2 = tracker.id, other_tracker.id
-                        else:
-                            obj2, obj1 = tracker.id, other_tracker.id
-                        couple = str(obj1) + ":" + str(obj2)
-                        if other_tracker.near_miss and not couple in self.collision_couples:
-                            self.collision_count += 1
-                            TrackingSystem.total_collision_count += 1
-                            if self.influx_client:
-                                self.influx_client.collision_count[self.channel_id] = self.collision_count
-                                self.influx_client.total_collision_count = TrackingSystem.total_collision_count
-                                self.influx_client.collision_events.append(f'Collision detected at - {self.cam_config["address"]}')
-                            self.collision_couples.append(couple)
-                        if (not other_tracker.near_miss) and (self.n_obj1 != obj1 or self.n_obj2 != obj2):
-                            self.near_miss += 1
-                            if self.influx_client:
-                                self.influx_client.near_miss_count[self.channel_id] = self.near_miss
-                            self.n_obj1, self.n_obj2 = obj1, obj2
-                        if other_tracker.near_miss:
-                            other_tracker.collision, other_tracker.color = True, (0, 0, 225)
-                            tracker.collision, tracker.color = True, (0, 0, 225)
-                        else:
-                            other_tracker.color = (0, 165, 255)
-                            tracker.color = (0, 165, 255)
+                for other_tracker in (trackers[other] for other in sorted(overlapping[index])):
+                    tracker.rect_width = 2
+                    other_tracker.rect_width = 2
+                    if tracker.id < other_tracker.id:
+                        obj1, obj2 = tracker.id, other_tracker.id
+                    else:
+                        obj2, obj1 = tracker.id, other_tracker.id
+                    couple = (obj1, obj2)
+                    if other_tracker.near_miss and not couple in self.collision_couples:
+                        self.collision_count += 1
+                        TrackingSystem.total_collision_count += 1
+                        if self.influx_client:
+                            self.influx_client.collision_count[self.channel_id] = self.collision_count
+                            self.influx_client.total_collision_count = TrackingSystem.total_collision_count
+                            # Stamped with the capture time of the frame
+                            event_ts = self.last_timestamp or time.time()
+                            self.influx_client.collision_events.append(
+                                (event_ts, self.channel_id, f'Collision detected at - {self.cam_config["address"]}'))
+                        self.collision_couples.add(couple)
+                    if (not other_tracker.near_miss) and (self.n_obj1 != obj1 or self.n_obj2 != obj2):
+                        self.near_miss += 1
+                        if self.influx_client:
+                            self.influx_client.near_miss_count[self.channel_id] = self.near_miss
+                        self.n_obj1, self.n_obj2 = obj1, obj2
+                    if other_tracker.near_miss:
+                        other_tracker.collision, other_tracker.color = True, (0, 0, 225)
+                        tracker.collision, tracker.color = True, (0, 0, 225)
+                    else:
+                        other_tracker.color = (0, 165, 255)
+                        tracker.color = (0, 165, 255)
         self.total_frames += 1
         return True
 
@@ -586,6 +868,6 @@ class TrackingSystem:
         """
         Deallocate all memory and close the program.
         """
-        self.manager.tracker_vec = []
+        self.manager.clear()
         return True
 
@@ -0,0 +1,463 @@
+"""
+Copyright 2022 Intel Corporation
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+    http://www.apache.org/licenses/LICENSE-2.0
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import numpy as np
+from association import NO_LABEL, associate, rect_array
+from motion import GATING_THRESHOLD, MOTION_AVERAGE, MOTION_KALMAN, KalmanModel
+from utils import Point, Rect
+
+# Same constants as SingleTracker
+ACC_FACTOR = 1000
+CENTER_FRAMES = 5
+HISTORY_LEN = 50
+AVG_FRAMES = 5
+DELETE_FRAMES = 10
+
+
+class TrackView(object):
+    """
+    SingleTracker-like view on one row of a VectorTrackingManager.
+    Views are only valid until the next VectorTrackingManager.track_all,
+    history queues are returned as lists.
+    """
+    __slots__ = ('_m', '_i')
+
+    def __init__(self, manager, index):
+        self._m = manager
+        self._i = index
+
+    @property
+    def id(self):
+        return int(self._m.ids[self._i])
+
+    @property
+    def label(self):
+        label = int(self._m.labels[self._i])
+        return None if label == NO_LABEL else label
+
+    @property
+    def color(self):
+        return tuple(int(c) for c in self._m.colors[self._i])
+
+    @color.setter
+    def color(self, color):
+        self._m.colors[self._i] = color
+
+    @property
+    def rect(self):
+        return Rect(*self._m.rects[self._i].tolist())
+
+    @property
+    def center(self):
+        return Point(*self._m.centers[self._i].tolist())
+
+    @property
+    def vel(self):
+        return Point(*(self._m.centers[self._i] + self._m.vel[self._i]).tolist())
+
+    @property
+    def acc(self):
+        return Point(*(self._m.centers[self._i] + self._m.acc[self._i]).tolist())
+
+    @property
+    def vel_x(self):
+        return float(self._m.vel[self._i, 0])
+
+    @property
+    def vel_y(self):
+        return float(self._m.vel[self._i, 1])
+
+    @property
+    def acc_x(self):
+        return float(self._m.acc[self._i, 0])
+
+    @property
+    def acc_y(self):
+        return float(self._m.acc[self._i, 1])
+
+    @property
+    def mod_vel(self):
+        return float(self._m.mod_vel[self._i])
+
+    @property
+    def mod_acc(self):
+        return float(self._m.mod_acc[self._i])
+
+    @property
+    def c_q(self):
+        return self._m.c_hist[self._i, :self._m.c_len[self._i], :2]
+
+    @property
+    def avg_pos(self):
+        return [Point(x, y) for x, y in self._m.avg_hist[self._i, :self._m.avg_len[self._i], :2].tolist()]
+
+    @property
+    def v_x_q(self):
+        return self._m.v_hist[self._i, :self._m.v_len[self._i], 0].tolist()
+
+    @property
+    def v_y_q(self):
+        return self._m.v_hist[self._i, :self._m.v_len[self._i], 1].tolist()
+
+    @property
+    def v_q(self):
+        return self._m.v_hist[self._i, :self._m.v_len[self._i], 2].tolist()
+
+    @property
+    def a_x_q(self):
+        return self._m.a_hist[self._i, :self._m.a_len[self._i], 0].tolist()
+
+    @property
+    def a_y_q(self):
+        return self._m.a_hist[self._i, :self._m.a_len[self._i], 1].tolist()
+
+    @property
+    def a_q(self):
+        return self._m.a_hist[self._i, :self._m.a_len[self._i], 2].tolist()
+
+    @property
+    def no_update_counter(self):
+        return float(self._m.no_update[self._i])
+
+    @property
+    def to_delete(self):
+        return bool(self._m.to_delete[self._i])
+
+    @property
+    def near_miss(self):
+        return bool(self._m.near_miss[self._i])
+
+    @near_miss.setter
+    def near_miss(self, value):
+        self._m.near_miss[self._i] = value
+
+    @property
+    def collision(self):
+        return bool(self._m.collision[self._i])
+
+    @collision.setter
+    def collision(self, value):
+        self._m.collision[self._i] = value
+
+    @property
+    def rect_width(self):
+        return int(self._m.rect_width[self._i])
+
+    @rect_width.setter
+    def rect_width(self, value):
+        self._m.rect_width[self._i] = value
+
+
+class VectorTrackingManager:
+    """
+    TrackingManager keeping all tracks of a channel in NumPy arrays
+    (struct of arrays), advanced and pruned with batched array operations
+    instead of one SingleTracker thread per track.
+    Kinematics match SingleTracker: positions averaged over the last
+    5 centers, velocity and acceleration averaged over the last 5 frames,
+    or filtered by a KalmanModel with the 'kalman' <motion_model>.
+    """
+
+    total_vehicle_count = 0
+    total_bicycle_count = 0
+    total_people_count = 0
+
+    # name: (shape after the track axis, dtype, initial value)
+    FIELDS = {
+        'ids': ((), np.int64, 0),
+        'labels': ((), np.int64, NO_LABEL),
+        'colors': ((3,), np.int64, 0),
+        'rects': ((4,), np.float64, 0),
+        'centers': ((2,), np.float64, 0),
+        'updated': ((), bool, False),
+        'no_update': ((), np.float64, 0),
+        'to_delete': ((), bool, False),
+        'near_miss': ((), bool, False),
+        'collision': ((), bool, False),
+        'rect_width': ((), np.int64, 0),
+        # Histories carry the clock of each entry in their last column
+        'c_hist': ((CENTER_FRAMES, 3), np.float64, 0),
+        'c_len': ((), np.int64, 0),
+        'avg_hist': ((HISTORY_LEN, 3), np.float64, 0),
+        'avg_len': ((), np.int64, 0),
+        'v_hist': ((HISTORY_LEN, 4), np.float64, 0),
+        'v_len': ((), np.int64, 0),
+        'a_hist': ((HISTORY_LEN, 3), np.float64, 0),
+        'a_len': ((), np.int64, 0),
+        'vel': ((2,), np.float64, 0),
+        'mod_vel': ((), np.float64, 0),
+        'acc': ((2,), np.float64, 0),
+        'mod_acc': ((), np.float64, 0),
+        'kf_x': ((6,), np.float64, 0),
+        'kf_P': ((6, 6), np.float64, 0),
+    }
+
+    def __init__(self, channel_id=None, influx_client=None, motion_model=MOTION_AVERAGE):
+        self.channel_id = channel_id
+        # Time elapsed since the previous frame and since the first one,
+        # in reference frames (see TrackingSystem.set_timestamp)
+        self.dt = 1.0
+        self.clock = 0.0
+        self.kalman = KalmanModel() if motion_model == MOTION_KALMAN else None
+        self.id_list = 0
+        self.people_count = 0
+        self.vehicle_count = 0
+        self.bicycle_count = 0
+        self.influx_client = influx_client
+        self.clear()
+
+    def clear(self):
+        """
+        Remove all tracks
+        """
+        for name, (shape, dtype, _) in self.FIELDS.items():
+            setattr(self, name, np.zeros((0,) + shape, dtype=dtype))
+        self.rows = {}
+
+    def __len__(self):
+        return len(self.ids)
+
+    @property
+    def tracker_vec(self):
+        return [TrackView(self, i) for i in range(len(self.ids))]
+
+    def _add_row(self, rect, color, target_id, label):
+        for name, (shape, dtype, value) in self.FIELDS.items():
+            row = np.full((1,) + shape, value, dtype=dtype)
+            setattr(self, name, np.concatenate((getattr(self, name), row)))
+        i = len(self.ids) - 1
+        self.ids[i] = target_id
+        self.labels[i] = NO_LABEL if label is None else label
+        self.colors[i] = color if color is not None else (0, 0, 0)
+        self.rects[i] = (rect.x, rect.y, rect.width, rect.height)
+        self.centers[i] = self.rects[i, :2] + self.rects[i, 2:] / 2
+        if self.kalman:
+            x, P = self.kalman.initiate(self.centers[i:i + 1])
+            self.kf_x[i], self.kf_P[i] = x[0], P[0]
+        self.rows[target_id] = i
+
+    def _keep_rows(self, keep):
+        for name in self.FIELDS:
+            setattr(self, name, getattr(self, name)[keep])
+        self.rows = {target_id: i for i, target_id in enumerate(self.ids.tolist())}
+
+    def insert_tracker_by_id(self, _init_rect, _color, _target_id, _label, update):
+        """
+        Create new track or update the track with ID : _target_id.
+        Same return values as TrackingManager.insert_tracker_by_id.
+        """
+        if _init_rect.area() == 0:
+            return False
+        i = self.rows.get(_target_id)
+        if i is not None:
+            if update is False:
+                return False
+            self.rects[i] = (_init_rect.x, _init_rect.y, _init_rect.width, _init_rect.height)
+            self.centers[i] = self.rects[i, :2] + self.rects[i, 2:] / 2
+            self.updated[i] = update
+            self.no_update[i] = 0
+            if self.labels[i] == NO_LABEL:
+                self.labels[i] = _label
+                self.colors[i] = _color
+            return []
+        self._add_row(_init_rect, _color, _target_id, _label)
+        self.id_list = _target_id + 1
+        if _label == 1:
+            self.people_count += 1
+            VectorTrackingManager.total_people_count += 1
+        elif _label == 0:
+            self.vehicle_count += 1
+            VectorTrackingManager.total_vehicle_count += 1
+        elif _label == 2:
+            self.bicycle_count += 1
+            VectorTrackingManager.total_bicycle_count += 1
+        return [self.people_count, self.vehicle_count, self.bicycle_count]
+
+    def find_tracker_by_id(self, _target_id):
+        """
+        Return row of track with ID : _target_id, else False
+        """
+        i = self.rows.get(_target_id)
+        return False if i is None else i
+
+    def find_tracker(self, rect, label):
+        """
+        Find track matching <rect> among all tracks at once.
+        Return its ID, a new ID if no track overlaps or -1.
+        """
+        if not len(self.ids):
+            return self.id_list
+        area = rect.height * rect.width
+        x1 = np.maximum(self.rects[:, 0], rect.x)
+        y1 = np.maximum(self.rects[:, 1], rect.y)
+        x2 = np.minimum(self.rects[:, 0] + self.rects[:, 2], rect.x + rect.width)
+        y2 = np.minimum(self.rects[:, 1] + self.rects[:, 3], rect.y + rect.height)
+        in_area = np.where((x2 < x1) | (y2 < y1), 0, (x2 - x1) * (y2 - y1))
+        track_area = self.rects[:, 2] * self.rects[:, 3]
+        max_per_area = np.maximum(in_area / track_area, in_area / area)
+        new_object = not np.any(max_per_area > 0.2)
+        center = (rect.x + rect.width / 2, rect.y + rect.height / 2)
+        distance = ((self.centers[:, 0] - center[0])**2 + (self.centers[:, 1] - center[1])**2)
+        selected = ((self.labels == label) | (self.labels == NO_LABEL)) & (distance < area / 2)
+        if np.any(selected):
+            return int(self.ids[np.argmin(np.where(selected, distance, np.inf))])
+        if new_object:
+            return self.id_list
+        return -1
+
+    def associate(self, detections):
+        """
+        Match list of (rect, label) <detections> to tracks at once.
+        Return the track ID of each detection, NEW_TRACK or NO_TRACK.
+        """
+        det_rects = rect_array([d[0] for d in detections])
+        track_rects, gating = self.rects, None
+        if self.kalman and len(self.ids):
+            # Match against the predicted positions, within their uncertainty
+            x, P = self.kalman.predict(self.kf_x, self.kf_P, self.dt)
+            track_rects = self.rects.copy()
+            track_rects[:, :2] = x[:, :2] - track_rects[:, 2:] / 2
+            det_centers = det_rects[:, :2] + det_rects[:, 2:] / 2
+            gating = self.kalman.gating_distance(x, P, det_centers) < GATING_THRESHOLD
+        rows = associate(track_rects, self.labels, det_rects,
+                         np.array([d[1] for d in detections], dtype=np.int64), gating)
+        return [int(self.ids[row]) if row >= 0 else int(row) for row in rows]
+
+    def delete_tracker(self, _target_id):
+        """
+        Delete track with ID : _target_id
+        """
+        i = self.rows.get(_target_id)
+        if i is None:
+            return False
+        keep = np.ones(len(self.ids), dtype=bool)
+        keep[i] = False
+        self._keep_rows(keep)
+        return True
+
+    def get_total_counts(self):
+        """
+        Return total counts
+        """
+        return [VectorTrackingManager.total_people_count,
+                VectorTrackingManager.total_vehicle_count,
+                VectorTrackingManager.total_bicycle_count]
+
+    @staticmethod
+    def _push(hist, lens, rows, values):
+        """
+        Insert <values> at the front of the histories of <rows>
+        """
+        hist[rows, 1:] = hist[rows, :-1]
+        hist[rows, 0] = values[rows]
+        lens[rows] = np.minimum(lens[rows] + 1, hist.shape[1])
+
+    @staticmethod
+    def _rates(hist, column):
+        """
+        Return the first AVG_FRAMES rates of change of <hist>[..., column]
+        between consecutive entries, per reference frame
+        """
+        window = hist[:, :AVG_FRAMES + 1]
+        elapsed = window[:, :-1, -1:] - window[:, 1:, -1:]
+        delta = window[:, :-1, column] - window[:, 1:, column]
+        return delta / np.where(elapsed > 0, elapsed, 1)
+
+    @staticmethod
+    def _window_mean(deltas, lens):
+        """
+        Mean of the first min(AVG_FRAMES, lens - 1) <deltas> of each row,
+        and mask of the rows where that is more than 1 frame.
+        """
+        limit = np.minimum(AVG_FRAMES, lens - 1)
+        valid = limit > 1
+        mask = np.arange(AVG_FRAMES)[None, :] < limit[:, None]
+        total = (deltas * mask[:, :, None]).sum(axis=1)
+        return total / np.maximum(limit, 1)[:, None], valid
+
+    def _advance_average(self):
+        """
+        Moving average kinematics, as SingleTracker
+        """
+        # Tracks without a detection in this frame move with their velocity
+        missed = ~self.updated
+        self.rects[missed, :2] += self.vel[missed] * self.dt
+        self.centers = self.rects[:, :2] + self.rects[:, 2:] / 2
+        clock = np.full((len(self.ids), 1), self.clock)
+        everyone = np.ones(len(self.ids), dtype=bool)
+        self._push(self.c_hist, self.c_len, everyone, np.hstack((self.centers, clock)))
+
+        full = self.c_len == CENTER_FRAMES
+        self._push(self.avg_hist, self.avg_len, full, self.c_hist.mean(axis=1))
+
+        vel, has_vel = self._window_mean(self._rates(self.avg_hist, slice(0, 2)), self.avg_len)
+        self.vel = np.where(has_vel[:, None], vel, 0)
+        self.mod_vel = np.hypot(self.vel[:, 0], self.vel[:, 1])
+        self._push(self.v_hist, self.v_len, has_vel,
+                   np.column_stack((self.vel, self.mod_vel, self.avg_hist[:, 0, 2])))
+
+        scale = ACC_FACTOR / (self.avg_hist[:, :AVG_FRAMES, 1:2] + 10)
+        acc, has_acc = self._window_mean(self._rates(self.v_hist, slice(0, 2)) * scale, self.v_len)
+        self.acc = np.where(has_acc[:, None], acc, 0)
+        self.mod_acc = np.hypot(self.acc[:, 0], self.acc[:, 1])
+        self._push(self.a_hist, self.a_len, has_acc,
+                   np.column_stack((self.acc, self.mod_acc)))
+
+    def _advance_kalman(self):
+        """
+        Kalman filter kinematics: predict all tracks, correct the updated
+        ones with their detection.
+        """
+        self.kf_x, self.kf_P = self.kalman.predict(self.kf_x, self.kf_P, self.dt)
+        updated = self.updated
+        if np.any(updated):
+            self.kf_x[updated], self.kf_P[updated] = self.kalman.update(
+                self.kf_x[updated], self.kf_P[updated], self.centers[updated])
+        self.centers = self.kf_x[:, :2].copy()
+        self.rects[:, :2] = self.centers - self.rects[:, 2:] / 2
+        clock = np.full((len(self.ids), 1), self.clock)
+        everyone = np.ones(len(self.ids), dtype=bool)
+        self._push(self.c_hist, self.c_len, everyone, np.hstack((self.centers, clock)))
+        # Filtered positions need no further averaging
+        self._push(self.avg_hist, self.avg_len, everyone, np.hstack((self.centers, clock)))
+        self.vel = self.kf_x[:, 2:4].copy()
+        self.mod_vel = np.hypot(self.vel[:, 0], self.vel[:, 1])
+        self._push(self.v_hist, self.v_len, everyone,
+                   np.column_stack((self.vel, self.mod_vel, clock)))
+        # Same perspective scaling as the moving average acceleration
+        self.acc = self.kf_x[:, 4:6] * ACC_FACTOR / (self.centers[:, 1:2] + 10)
+        self.mod_acc = np.hypot(self.acc[:, 0], self.acc[:, 1])
+        self._push(self.a_hist, self.a_len, everyone,
+                   np.column_stack((self.acc, self.mod_acc)))
+
+    def track_all(self, frame_width, frame_height):
+        """
+        Advance all tracks by <dt> and delete the lost ones.
+        """
+        self.clock += self.dt
+        if not len(self.ids):
+            return True
+        if self.kalman:
+            self._advance_kalman()
+        else:
+            self._advance_average()
+        self.updated[:] = False
+        self.no_update += self.dt
+        min_vel = 0.01 * self.rects[:, 2] * self.rects[:, 3]
+        self.to_delete |= (self.no_update >= DELETE_FRAMES) & (self.mod_vel < min_vel)
+        in_frame = ((self.centers[:, 0] >= 0) & (self.centers[:, 0] < frame_width) &
+                    (self.centers[:, 1] >= 0) & (self.centers[:, 1] < frame_height))
+        keep = in_frame & ~self.to_delete
+        if not np.all(keep):
+            self._keep_rows(keep)
+        return True
@@ -18,6 +18,7 @@ import re
 import requests
 import sys
 import time
+from common.util import asgi
 from flask import Flask, render_template, make_response
 
 app = Flask(__name__)
@@ -34,6 +35,17 @@ GRAFANA_PORT = "3000"
 INFLUXDB_URL = "influxdb.{}.svc.cluster.local:8086".format(NAMESPACE)
 PSQL_USER = os.getenv("PSQL_USER")
 PSQL_PASS = os.getenv("PSQL_PASS")
+# InfluxDB schema written by ITMAnalytics: dashboards of the 'legacy'
+# schema query a measurement per channel, the others the tagged
+# measurements
+INFLUX_SCHEMA = os.getenv("INFLUX_SCHEMA", "legacy")
+# 'flask' runs the Flask development server, 'asgi' serves the requests
+# from an asyncio event loop so slow clients do not block the others
+SERVING_MODE = os.getenv("SERVING_MODE", "flask")
+SSL_CONTEXT = ('/app/itm.pem', '/app/itm-key.pem')
+# Stream rendition of the channel dashboard panels: width, JPEG quality
+# and frame rate cap
+PANEL_STREAM_QUERY = "w=640&q=70&fps=10"
 
 MAP_JS_CDN = "https://cdn.jsdelivr.net/gh/openlayers/openlayers.github.io@master/en/v6.4.3/build/ol.js"
 JS_CDN_INTEGRITY = "sha384-RffttofZaGGmE3uVvQmIW/dh1bzuHAJtWkxFyjRkb7eaUWfHo3W3GV8dcET2xTPI"
@@ -170,10 +182,15 @@ class GrafanaConnect:
         with open(template_path, 'r') as f:
             str_data = f.read()
         for i in range(0, NUM_CH):
-            st = re.sub("channel0", f'channel{i}', str_data)
-            final_data = json.loads(st)
+            if INFLUX_SCHEMA == "legacy":
+                st = re.sub("channel0", f'channel{i}', str_data)
+                final_data = json.loads(st)
+            else:
+                final_data = json.loads(str_data)
+                set_constant(final_data, 'node', camera_conf["cameras"][i]["name"])
+                set_constant(final_data, 'channel', camera_conf["cameras"][i]["cam_index"])
             final_data['dashboard']['title'] = f'ITM ({camera_conf["cameras"][i]["name"]}) - {camera_conf["cameras"][i]["address"]}'
-            final_data['dashboard']['panels'][2]['url'] = "https://" + camera_conf["cameras"][i]["server_ip"] + f'/camera/{i}'
+            final_data['dashboard']['panels'][2]['url'] = "https://" + camera_conf["cameras"][i]["server_ip"] + f'/camera/{i}?{PANEL_STREAM_QUERY}'
             final_data['dashboard']['panels'][2]['method'] = "iframe"
             res = self.add_dashboard(final_data, f'/camera/{i}')
             url_data[i] = GRAFANA_EXTERNAL_URL + res['url']
@@ -207,6 +224,18 @@ class GrafanaConnect:
         return url_data
 
 
+def set_constant(json_data, name, value):
+    """
+    Set the constant template variable <name> of a dashboard
+    """
+    value = str(value)
+    for variable in json_data['dashboard']['templating']['list']:
+        if variable['name'] == name:
+            variable['query'] = value
+            variable['current'] = {'selected': False, 'text': value, 'value': value}
+            variable['options'] = [{'selected': True, 'text': value, 'value': value}]
+
+
 @app.route('/dashboard')
 def dashboard():
     """
@@ -273,9 +302,10 @@ def init_all(over_write=False):
     # log.info(conf_data)
     NUM_CH, CONF_DATA = num_ch, conf_data
     grafana_connect = GrafanaConnect(GRAFANA_URL, MAP_SERVER_URL, INFLUXDB_URL, 'admin', GRAFANA_PASSWORD)
+    suffix = '' if INFLUX_SCHEMA == "legacy" else '_tagged'
     URL_DATA = grafana_connect.init_grafana_server(CONF_DATA, 'grafana_templates/datasource_template.json',
-                                                  'grafana_templates/consolidated_dashboard_template.json',
-                                                  'grafana_templates/channel_dashboard_template.json')
+                                                  f'grafana_templates/consolidated_dashboard{suffix}_template.json',
+                                                  f'grafana_templates/channel_dashboard{suffix}_template.json')
     if URL_DATA == -1:
        sys.exit(-1)
 
@@ -297,7 +327,10 @@ def main():
     init_all(over_write=True)
 
     try:
-        app.run(host=LOCAL_HOST, port=LOCAL_PORT, threaded=False, ssl_context=('/app/itm.pem', '/app/itm-key.pem'))
+        if SERVING_MODE == "asgi":
+            asgi.serve(asgi.App(app), LOCAL_HOST, LOCAL_PORT, SSL_CONTEXT)
+        else:
+            app.run(host=LOCAL_HOST, port=LOCAL_PORT, threaded=False, ssl_context=SSL_CONTEXT)
     except KeyboardInterrupt:
         process.terminate()
 
@@ -13,6 +13,7 @@ limitations under the License.
 
 import common.util.publisher_manager as pub
 import cv2
+import itertools
 import json
 import numpy as np
 import os
@@ -20,20 +21,57 @@ import queue
 import random
 import string
 import threading
-from collections import deque
+import time
+from common.util import trace
 from common.util.logger import get_logger
+from common.util.shared_deque import SharedDeque
 from gi.repository import Gst
 from gstgva.util import gst_buffer_data
 from vaserving.vaserving import VAServing
 from vaserving.gstreamer_app_destination import GStreamerAppDestination
 
 
-def format_frame(input_queue, output_queue, log, cfg):
+class SourceClock:
+    """
+    Map the buffer timestamps of VA Serving <pipeline> to wall-clock capture
+    times: the age of a buffer is the pipeline clock time minus the base
+    time and the buffer running time, so decode and inference count in the
+    frame latency. Until the GStreamer pipeline runs, and for buffers
+    without timestamp, frames are stamped when dequeued.
+    """
+
+    def __init__(self, pipeline=None):
+        self.pipeline = pipeline
+
+    def capture_ts(self, sample):
+        now = time.time()
+        # Created by VA Serving once the pipeline starts, and again on restart
+        element = getattr(self.pipeline, 'pipeline', None)
+        clock = element.get_clock() if element is not None else None
+        pts = sample.get_buffer().pts
+        if clock is None or pts == Gst.CLOCK_TIME_NONE:
+            return now
+        running_time = sample.get_segment().to_running_time(Gst.Format.TIME, pts)
+        if running_time == Gst.CLOCK_TIME_NONE:
+            return now
+        age = clock.get_time() - element.get_base_time() - running_time
+        return now - max(age, 0) / Gst.SECOND
+
+
+def format_frame(input_queue, output_queue, log, cfg, source_clock=None):
+    # Frame sequence numbers of the camera, stable across services unlike
+    # img_handle
+    sequence = itertools.count()
+    source_clock = source_clock or SourceClock()
     while True:
         msg = input_queue.get()
         if not msg:
             continue
-        meta_data = {'img_handle': ''.join(random.choices(string.ascii_uppercase + string.digits, k=10))}  #nosec
+        capture_ts = source_clock.capture_ts(msg.sample)
+        meta_data = {'img_handle': ''.join(random.choices(string.ascii_uppercase + string.digits, k=10)),  #nosec
+                     trace.SEQ: next(sequence),
+                     trace.CAPTURE_TS: capture_ts}
+        trace.enter(meta_data, 'inference', capture_ts)
 
         if msg.video_frame:
             for message in list(msg.video_frame.messages()):
@@ -49,6 +87,7 @@ def format_frame(input_queue, output_queue, log, cfg):
                 meta_data['encoding_type'] = "jpeg"
                 meta_data['encoding_level'] = cfg['encoding_level']
 
+            trace.leave(meta_data)
             output_queue.append(meta_data)
 
 
@@ -71,10 +110,12 @@ class ITM:
         })
 
         log.info("App_cfg {}".format(self.app_cfg))
-        self.output_queue = deque(maxlen=20)
+        self.output_queue = SharedDeque(maxlen=20)
         self.input_queue = queue.Queue(20)
         pub.configure(self.log, self.output_queue)
-        threading.Thread(target=format_frame, args=(self.input_queue, self.output_queue, self.log, self.app_cfg)).start()
+        self.source_clock = SourceClock()
+        threading.Thread(target=format_frame, args=(self.input_queue, self.output_queue, self.log, self.app_cfg,
+                                                    self.source_clock)).start()
         self.dest = {
                 'type': 'application',
                 'class': 'GStreamerAppDestination',
@@ -91,6 +132,7 @@ class ITM:
         self.pipeline = VAServing.pipeline(self.pipeline_name, self.pipeline_version)
         if self.pipeline is None:
             raise RuntimeError('Failed to initialize  pipeline')
+        self.source_clock.pipeline = self.pipeline
 
         log.info('Starting pipeline {} ---------- {}'.format(self.src, self.dest))
         self.pipeline.start(source=self.src,
@@ -105,6 +147,7 @@ class ITM:
         while True:
             VAServing.wait()
             pipeline = VAServing.pipeline(self.pipeline_name, self.pipeline_version)
+            self.source_clock.pipeline = pipeline
             pipeline.start(source=self.src,
                             destination=self.dest,
                             parameters=self.model_params)
@@ -12,7 +12,7 @@ limitations under the License.
 """
 import datetime
 import rule_engine
-import time
+from common.util import trace
 from common.util.logger import get_logger
 
 log = get_logger(__name__)
@@ -69,15 +69,16 @@ def start(input_queue, output_queue, json_config):
         for cfg_rule in cfg_rules:
             rules.append(rule_engine.Rule(cfg_rules[cfg_rule]))
         while True:
-            if input_queue:
-                frame = input_queue.popleft()
-            else:
-                time.sleep(0.005)
+            try:
+                frame = input_queue.popleft(block=True, timeout=1)
+            except IndexError:
                 continue
+            trace.enter(frame, 'filter')
             if filter_message(frame, rules):
                 continue
             if filter_by_frequency(frame, json_config):
                 continue
+            trace.leave(frame)
             output_queue.append(frame)
             del frame
     except KeyboardInterrupt:
@@ -10,21 +10,50 @@ WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 See the License for the specific language governing permissions and
 limitations under the License.
 """
-import time
+import queue
+from common.util import trace
 from common.util.logger import get_logger
 
+# Frame fields forwarded to the cloud connector along with the image
+TRACE_FIELDS = ('camera_id', trace.SEQ, trace.CAPTURE_TS, trace.HOPS)
+# Seconds to wait for new frames while images are being fetched
+FETCH_POLL = 0.05
 
-def start(input_queue, output_queue):
+
+def start(input_queue, output_queue, image_client=None, tracer=None):
     log = get_logger(__name__)
+    # (frame, new_frame, img) of the requested images, img None if missing
+    fetched = queue.SimpleQueue()
+    pending = 0
+
+    def finish(frame, new_frame):
+        trace.leave(frame)
+        for field in TRACE_FIELDS:
+            if field in frame:
+                new_frame[field] = frame[field]
+        if tracer is not None:
+            tracer.observe(new_frame, new_frame.get('camera_id'))
+        output_queue.append(new_frame)
 
     try:
         log.info("Formatter thread started")
         while True:
-            if input_queue:
-                frame = input_queue.popleft()
-            else:
-                time.sleep(0.005)
+            while pending:
+                try:
+                    frame, new_frame, img = fetched.get_nowait()
+                except queue.Empty:
+                    break
+                pending -= 1
+                if img is None:
+                    log.warning(f"No image for {new_frame['title']}, dropping")
+                    continue
+                new_frame['img'] = img
+                finish(frame, new_frame)
+            try:
+                frame = input_queue.popleft(block=True, timeout=FETCH_POLL if pending else 1)
+            except IndexError:
                 continue
+            trace.enter(frame, 'formatter')
             new_frame = {}
             title = 'cap_'
             if frame['event_type'] != 'none':
@@ -34,8 +63,18 @@ def start(input_queue, output_queue):
             title = title + "_" + frame['img_handle'] + "_" + frame['timestamp']
             new_frame['title'] = title
             log.debug(new_frame)
-            new_frame['img'] = frame['img']
-            output_queue.append(new_frame)
+            if 'img' in frame:
+                new_frame['img'] = frame['img']
+                finish(frame, new_frame)
+            elif image_client is not None:
+                # Split frames only carry metadata, fetch the image of the
+                # frames that passed the rules without holding back the
+                # next frames
+                pending += 1
+                image_client.request(frame, lambda img, frame=frame, new_frame=new_frame:
+                                     fetched.put((frame, new_frame, img)))
+            else:
+                log.warning(f"No image for {title}, dropping")
             del new_frame
             del frame
     except Exception as e:
@@ -17,17 +17,18 @@ import formatter
 import threading
 import json
 import jsonschema
-from common.util import publisher_manager, subscriber_manager
+from common.util import image_channel, publisher_manager, subscriber_manager, trace
+from common.util import metrics as prom
 from common.util.logger import get_logger
-from collections import deque
+from common.util.shared_deque import SharedDeque
 
 log = get_logger(__name__)
 
 
 def main():
-    input_queue = deque(maxlen=20)
-    filter_queue = deque(maxlen=20)
-    formatted_queue = deque(maxlen=20)
+    input_queue = SharedDeque(maxlen=20)
+    filter_queue = SharedDeque(maxlen=20)
+    formatted_queue = SharedDeque(maxlen=20)
     publisher_manager.configure(log, formatted_queue)
     subscriber_manager.configure(log, input_queue)
     with open("/app/config.json") as fd:
@@ -35,13 +36,21 @@ def main():
     with open("/app/schema.json") as fd:
         json_schema = json.load(fd)
     jsonschema.validate(instance=json_config, schema=json_schema)
+    metrics = prom.Metrics()
+    metrics.start(shared=False)
+    prom.serve(metrics, log)
+    image_client = None
+    if image_channel.is_split():
+        topic, mqtt_port, mqtt_broker = subscriber_manager.get_env_values(log)
+        image_client = image_channel.ImageClient(topic.split(), mqtt_broker, mqtt_port, log, metrics=metrics)
+        image_client.start()
     filter_thread = threading.Thread(
         target=filter.start,
         args=(input_queue, filter_queue, json_config)
     )
     formatter_thread = threading.Thread(
         target=formatter.start,
-        args=(filter_queue, formatted_queue)
+        args=(filter_queue, formatted_queue, image_client, trace.Tracer(metrics, 'rule_engine'))
     )
     filter_thread.start()
     formatter_thread.start()
@@ -56,6 +56,7 @@ cp $SCRIPT_DIR/itm-key.pem $SCRIPT_DIR/ITMDashboard/
 cp $SCRIPT_DIR/itm.pem $SCRIPT_DIR/ITMDashboard/
 
 cp -r $SCRIPT_DIR/common/ $SCRIPT_DIR/ITMAnalytics/
+cp -r $SCRIPT_DIR/common/ $SCRIPT_DIR/ITMDashboard/
 cp -r $SCRIPT_DIR/common/ $SCRIPT_DIR/ITMVideoInference/
 cp -r $SCRIPT_DIR/common/ $SCRIPT_DIR/CloudConnector/
 cp -r $SCRIPT_DIR/common/ $SCRIPT_DIR/RuleEngine/
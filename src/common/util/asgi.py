@@ -0,0 +1,221 @@
+"""
+Copyright 2022 Intel Corporation
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+    http://www.apache.org/licenses/LICENSE-2.0
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+import asyncio
+import io
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qsl
+import uvicorn
+
+# Threads running the requests of the WSGI app
+WSGI_WORKERS = 8
+
+
+class StreamResponse:
+    """
+    Response sent from the event loop, <body> is an async iterator of
+    chunks sent as they come, with the extra <headers> dict. Responses
+    without a body, like 304, have no <content_type>.
+    """
+
+    def __init__(self, body, content_type, status=200, headers=None):
+        self.body = body
+        self.content_type = content_type
+        self.status = status
+        self.headers = headers or {}
+
+
+async def chunks(*data):
+    """
+    Async iterator of the <data> chunks, the body of responses known in
+    full
+    """
+    for chunk in data:
+        yield chunk
+
+
+def _encode_headers(headers):
+    return [(name.lower().encode('latin-1'), value.encode('latin-1')) for name, value in headers.items()]
+
+
+def _environ(scope, body):
+    server = scope.get('server') or ('localhost', 80)
+    client = scope.get('client') or ('', 0)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', '').encode().decode('latin-1'),
+        'PATH_INFO': scope['path'].encode().decode('latin-1'),
+        'QUERY_STRING': scope['query_string'].decode('latin-1'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1]),
+        'REMOTE_ADDR': client[0],
+        'REMOTE_PORT': str(client[1]),
+        'SERVER_PROTOCOL': f"HTTP/{scope['http_version']}",
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': io.BytesIO(body),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': False,
+        'wsgi.run_once': False,
+    }
+    for name, value in scope['headers']:
+        name = name.decode('latin-1')
+        if name in ('content-type', 'content-length'):
+            key = name.upper().replace('-', '_')
+        else:
+            key = 'HTTP_' + name.upper().replace('-', '_')
+        value = value.decode('latin-1')
+        environ[key] = f'{environ[key]},{value}' if key in environ else value
+    return environ
+
+
+def _query(scope):
+    query = {}
+    for name, value in parse_qsl(scope['query_string'].decode('latin-1'), keep_blank_values=True):
+        query.setdefault(name, value)
+    return query
+
+
+def _headers(scope):
+    headers = {}
+    for name, value in scope['headers']:
+        name = name.decode('latin-1')
+        value = value.decode('latin-1')
+        headers[name] = f'{headers[name]},{value}' if name in headers else value
+    return headers
+
+
+def query_int(query, name, default=None):
+    """
+    Return query parameter <name> as an integer, <default> if missing or
+    not an integer, like Flask request.args.get(name, default, type=int)
+    """
+    try:
+        return int(query[name])
+    except (KeyError, ValueError):
+        return default
+
+
+class App:
+    """
+    ASGI application serving a Flask (WSGI) <wsgi_app> from one asyncio
+    event loop.
+    GET requests of the paths starting with a prefix of <routes> go to its
+    handler(path tail, query dict, lowercase headers dict), which returns
+    a StreamResponse answered from the loop, a coroutine of one, or None
+    to let <wsgi_app> answer. Long lived streams and requests waiting for
+    data then hold no thread.
+    Other requests run <wsgi_app> in a pool of <workers> threads and are
+    sent back by the loop once complete, so slow clients do not hold a
+    thread either. Their headers are the ones of <wsgi_app>, stream
+    responses get <headers>.
+    """
+
+    def __init__(self, wsgi_app, routes=None, headers=None, workers=WSGI_WORKERS):
+        self.wsgi_app = wsgi_app
+        self.routes = routes or {}
+        self.headers = _encode_headers(headers or {})
+        self.executor = ThreadPoolExecutor(workers)
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            return
+        if scope['method'] == 'GET':
+            for prefix, handler in self.routes.items():
+                if scope['path'].startswith(prefix):
+                    response = handler(scope['path'][len(prefix):], _query(scope), _headers(scope))
+                    if asyncio.iscoroutine(response):
+                        response = await response
+                    if response is not None:
+                        await self._stream(response, receive, send)
+                        return
+                    break
+        await self._wsgi(scope, receive, send)
+
+    async def _stream(self, response, receive, send):
+        headers = _encode_headers(response.headers) + self.headers
+        if response.content_type is not None:
+            headers.insert(0, (b'content-type', response.content_type.encode('latin-1')))
+        await send({'type': 'http.response.start', 'status': response.status, 'headers': headers})
+        disconnect = asyncio.ensure_future(self._wait_disconnect(receive))
+        body = response.body
+        chunk = None
+        try:
+            while True:
+                chunk = asyncio.ensure_future(body.__anext__())
+                await asyncio.wait((chunk, disconnect), return_when=asyncio.FIRST_COMPLETED)
+                if not chunk.done():
+                    # The viewer left while waiting for a chunk
+                    break
+                try:
+                    data = chunk.result()
+                except StopAsyncIteration:
+                    await send({'type': 'http.response.body', 'body': b''})
+                    break
+                await send({'type': 'http.response.body', 'body': data, 'more_body': True})
+        finally:
+            disconnect.cancel()
+            if chunk is not None and not chunk.done():
+                # The generator cleans up once the cancellation reaches it
+                chunk.cancel()
+                await asyncio.gather(chunk, return_exceptions=True)
+            await body.aclose()
+
+    @staticmethod
+    async def _wait_disconnect(receive):
+        while (await receive())['type'] != 'http.disconnect':
+            pass
+
+    async def _wsgi(self, scope, receive, send):
+        body = b''
+        more_body = True
+        while more_body:
+            message = await receive()
+            if message['type'] == 'http.disconnect':
+                return
+            body += message.get('body', b'')
+            more_body = message.get('more_body', False)
+        loop = asyncio.get_running_loop()
+        status, headers, chunks = await loop.run_in_executor(self.executor, self._run_wsgi,
+                                                             _environ(scope, body))
+        await send({'type': 'http.response.start', 'status': status, 'headers': headers})
+        for chunk in chunks:
+            await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+        await send({'type': 'http.response.body', 'body': b''})
+
+    def _run_wsgi(self, environ):
+        response = []
+        chunks = []
+
+        def start_response(status, headers, exc_info=None):
+            response[:] = [int(status.split(' ', 1)[0]),
+                           [(name.lower().encode('latin-1'), value.encode('latin-1')) for name, value in headers]]
+            return chunks.append
+
+        result = self.wsgi_app(environ, start_response)
+        try:
+            chunks.extend(chunk for chunk in result if chunk)
+        finally:
+            if hasattr(result, 'close'):
+                result.close()
+        return response[0], response[1], chunks
+
+
+def serve(app, host, port, ssl_context):
+    """
+    Run ASGI <app> on <host>:<port> with the (certificate, key) files of
+    <ssl_context>, like Flask app.run
+    """
+    uvicorn.run(app, host=host, port=int(port), ssl_certfile=ssl_context[0], ssl_keyfile=ssl_context[1],
+                lifespan='off')
@@ -0,0 +1,119 @@
+"""
+Copyright 2022 Intel Corporation
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+    http://www.apache.org/licenses/LICENSE-2.0
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+import ast
+import json
+import struct
+import zlib
+
+WIRE_BINARY = "binary"
+WIRE_LEGACY = "legacy"
+WIRE_FORMATS = (WIRE_BINARY, WIRE_LEGACY)
+
+# Binary envelope:
+#   | magic (4s) | version (B) | header length (I) | header (json) | blobs |
+# The header holds the frame metadata and the name and size of every raw
+# bytes value. Blobs (i.e. JPEG frames) follow the header verbatim, in the
+# order they are listed in the header.
+MAGIC = b"ITMF"
+VERSION = 1
+_PREFIX = struct.Struct("!4sBI")
+
+
+def encode(frame):
+    """
+    Serialize a frame dict into the binary envelope.
+    Top-level bytes-like values are carried as raw blobs, everything else
+    goes into the json header.
+    """
+    return b"".join(encode_parts(frame))
+
+
+def encode_parts(frame):
+    """
+    Same as encode, but return the envelope as a list of buffers so that
+    callers writing into preallocated memory can skip the join.
+    """
+    meta, blobs, sizes = {}, [], []
+    for key, value in frame.items():
+        if isinstance(value, (bytes, bytearray)):
+            blobs.append(value)
+            sizes.append([key, len(value)])
+        elif isinstance(value, memoryview):
+            blobs.append(value)
+            sizes.append([key, value.nbytes])
+        else:
+            meta[key] = value
+    header = json.dumps({"m": meta, "b": sizes}, separators=(",", ":")).encode()
+    return [_PREFIX.pack(MAGIC, VERSION, len(header)), header] + blobs
+
+
+def decode(payload, copy=True):
+    """
+    Deserialize a frame dict. Payloads without the binary envelope magic
+    are handled as legacy str()+zlib frames.
+    With copy=False blobs are returned as memoryviews into <payload>.
+    Raise ValueError for truncated or corrupt payloads.
+    """
+    try:
+        if bytes(payload[:len(MAGIC)]) != MAGIC:
+            frame = decode_legacy(payload)
+        else:
+            frame = _decode_binary(payload, copy)
+    except (struct.error, zlib.error, SyntaxError, KeyError, TypeError, MemoryError, RecursionError) as err:
+        raise ValueError(f"Malformed frame: {err!r}") from err
+    if not isinstance(frame, dict):
+        raise ValueError(f"Malformed frame: {type(frame).__name__} instead of dict")
+    return frame
+
+
+def _decode_binary(payload, copy):
+    _, version, header_len = _PREFIX.unpack_from(payload)
+    if version > VERSION:
+        raise ValueError(f"Unsupported frame envelope version: {version}")
+    offset = _PREFIX.size
+    header = json.loads(bytes(payload[offset:offset + header_len]))
+    offset += header_len
+    frame = header["m"]
+    view = memoryview(payload)
+    for key, size in header["b"]:
+        if offset + size > len(view):
+            raise ValueError(f"Truncated frame: blob {key} ends past the payload")
+        blob = view[offset:offset + size]
+        frame[key] = bytes(blob) if copy else blob
+        offset += size
+    return frame
+
+
+def encode_legacy(frame):
+    """
+    Serialize a frame dict the way publishers did before the binary envelope.
+    """
+    frame = {key: bytes(value) if isinstance(value, memoryview) else value
+             for key, value in frame.items()}
+    return zlib.compress(str(frame).encode())
+
+
+def decode_legacy(payload):
+    """
+    Deserialize a frame dict produced by encode_legacy.
+    """
+    return ast.literal_eval(zlib.decompress(payload).decode())
+
+
+def get_encoder(wire_format):
+    """
+    Return encode function for the given wire format.
+    """
+    if wire_format == WIRE_LEGACY:
+        return encode_legacy
+    return encode
@@ -0,0 +1,195 @@
+"""
+Copyright 2022 Intel Corporation
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+    http://www.apache.org/licenses/LICENSE-2.0
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+import collections
+import os
+import paho.mqtt.client as mqtt
+import threading
+import time
+from common.util import metrics as prom
+
+# In split mode publishers send frame metadata only and keep the image,
+# keyed by img_handle, until a subscriber requests it:
+#   request:  <topic>/img_req            payload: img_handle
+#   response: <topic>/img/<img_handle>   payload: JPEG bytes
+IMAGE_INLINE = "inline"
+IMAGE_SPLIT = "split"
+REQUEST_SUFFIX = "/img_req"
+RESPONSE_SUFFIX = "/img/"
+# Seconds a subscriber waits for an image before counting it missing
+FETCH_TIMEOUT = 0.5
+FETCH_TOTAL = 'itm_image_fetch_total'
+
+
+def is_split():
+    return os.getenv("IMAGE_CHANNEL", IMAGE_INLINE).lower() == IMAGE_SPLIT
+
+
+def get_store_size():
+    try:
+        return int(os.getenv("IMAGE_STORE_SIZE", "500"))
+    except ValueError:
+        return 500
+
+
+class ImageStore:
+    """
+    Bounded store of the most recently published images
+    """
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.images = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def put(self, img_handle, img):
+        with self.lock:
+            self.images[img_handle] = img
+            while len(self.images) > self.capacity:
+                self.images.popitem(last=False)
+
+    def get(self, img_handle):
+        with self.lock:
+            return self.images.get(img_handle)
+
+
+def request_topics(stores):
+    """
+    Return the subscriptions of the image requests of <stores>, a dict of
+    topic: ImageStore
+    """
+    return [(topic + REQUEST_SUFFIX, 0) for topic in stores]
+
+
+def request_handler(stores, log):
+    """
+    Return an MQTT on_message callback answering the image requests of
+    <stores>, a dict of topic: ImageStore, so publishers can answer them on
+    their own connection.
+    Unknown handles are not answered, since several publishers may share
+    a topic and only the owner of the image replies.
+    """
+    def on_message(client, _, msg):
+        topic = msg.topic[:-len(REQUEST_SUFFIX)]
+        store = stores.get(topic)
+        if store is None:
+            log.debug(f"{msg.topic} Unexpected topic")
+            return
+        img_handle = msg.payload.decode()
+        img = store.get(img_handle)
+        if img is None:
+            log.debug(f"{msg.topic} Unknown image {img_handle}")
+            return
+        client.publish(topic + RESPONSE_SUFFIX + img_handle, img, qos=0, retain=False)
+
+    return on_message
+
+
+def serve(store, topic, broker, port, log):
+    """
+    Answer image requests for <topic> from <store> on a connection of its
+    own
+    """
+    mqtt_c = None
+    req_topic = topic + REQUEST_SUFFIX
+
+    try:
+        log.info(f"{req_topic} Initializing image server")
+        mqtt_c = mqtt.Client()
+        mqtt_c.on_message = request_handler({topic: store}, log)
+        mqtt_c.connect(broker, int(port), 600)
+        mqtt_c.subscribe(request_topics({topic: store}))
+        mqtt_c.loop_forever()
+    except KeyboardInterrupt:
+        log.info(f"{req_topic} Quitting...")
+    finally:
+        if mqtt_c:
+            mqtt_c.disconnect()
+        log.info(f"{req_topic} Finishing...")
+
+
+class ImageClient:
+    """
+    Fetch images of split frames from their publishers.
+    Requests do not wait: the image, or None if no publisher answered in
+    <timeout> seconds, is handed to the request callback from the client
+    threads. Fetched and missing images are counted in <metrics>.
+    """
+    def __init__(self, topics, broker, port, log, timeout=FETCH_TIMEOUT, metrics=None):
+        self.topics = topics
+        self.broker = broker
+        self.port = port
+        self.log = log
+        self.timeout = timeout
+        self.pending = {}
+        self.lock = threading.Lock()
+        self.mqtt_c = None
+        self.running = False
+        self.fetched = 0
+        self.missed = 0
+        self.metrics = metrics
+        if metrics is not None:
+            for result in ('hit', 'miss'):
+                metrics.declare(prom.COUNTER, FETCH_TOTAL, 'Images of split frames fetched, by result',
+                                result=result)
+
+    def start(self):
+        def on_message(_, __, msg):
+            img_handle = msg.topic.rsplit("/", 1)[-1]
+            with self.lock:
+                request = self.pending.pop(img_handle, None)
+            if request is not None:
+                self._done(request[1], msg.payload)
+
+        self.mqtt_c = mqtt.Client()
+        self.mqtt_c.on_message = on_message
+        self.mqtt_c.connect(self.broker, int(self.port), 600)
+        self.mqtt_c.subscribe([(topic + RESPONSE_SUFFIX + "+", 0) for topic in self.topics])
+        self.mqtt_c.loop_start()
+        self.running = True
+        threading.Thread(target=self._expire, daemon=True).start()
+
+    def stop(self):
+        self.running = False
+        if self.mqtt_c:
+            self.mqtt_c.loop_stop()
+            self.mqtt_c.disconnect()
+
+    def _done(self, callback, img):
+        with self.lock:
+            if img is None:
+                self.missed += 1
+            else:
+                self.fetched += 1
+            if self.metrics is not None:
+                self.metrics.get(FETCH_TOTAL, result='miss' if img is None else 'hit').inc()
+        callback(img)
+
+    def _expire(self):
+        while self.running:
+            time.sleep(self.timeout / 5)
+            now = time.monotonic()
+            with self.lock:
+                expired = [(img_handle, self.pending.pop(img_handle)[1])
+                           for img_handle, (deadline, _) in list(self.pending.items()) if deadline <= now]
+            for img_handle, callback in expired:
+                self.log.warning(f"No image received for {img_handle}")
+                self._done(callback, None)
+
+    def request(self, frame, callback):
+        """
+        Request the image of <frame> from the topic it was published on,
+        callback(img) gets it, or None after the timeout
+        """
+        img_handle = frame['img_handle']
+        with self.lock:
+            self.pending[img_handle] = (time.monotonic() + self.timeout, callback)
+        self.mqtt_c.publish(frame['img_topic'] + REQUEST_SUFFIX, img_handle, qos=0)
@@ -0,0 +1,294 @@
+"""
+Copyright 2022 Intel Corporation
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+    http://www.apache.org/licenses/LICENSE-2.0
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+import bisect
+import http.server
+import os
+import threading
+import time
+from multiprocessing import shared_memory
+
+COUNTER = "counter"
+GAUGE = "gauge"
+HISTOGRAM = "histogram"
+
+# Upper bounds of the latency histogram buckets, in seconds
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# Quantiles and rates cover the last WINDOW_SLOTS periods of WINDOW seconds
+WINDOW = 10
+WINDOW_SLOTS = 6
+QUANTILES = (0.5, 0.95, 0.99)
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+class Counter(object):
+    def __init__(self, values, offset, _):
+        self.values = values
+        self.offset = offset
+
+    def inc(self, value=1):
+        self.values[self.offset] += value
+
+    def set(self, value):
+        """
+        Set the total, for counts kept by another object
+        """
+        self.values[self.offset] = value
+
+    def get(self):
+        return self.values[self.offset]
+
+
+class Gauge(Counter):
+    pass
+
+
+class Histogram(object):
+    """
+    Cumulative histogram, plus the bucket counts of the last WINDOW_SLOTS
+    periods used for quantiles and rates.
+    """
+
+    def __init__(self, values, offset, bounds):
+        self.values = values
+        self.bounds = bounds
+        self.num_buckets = len(bounds) + 1
+        self.sum_offset = offset + self.num_buckets
+        self.stamp_offset = self.sum_offset + 2
+        self.window_offset = self.stamp_offset + WINDOW_SLOTS
+        self.offset = offset
+
+    @staticmethod
+    def size(bounds):
+        # buckets, sum, count, window periods, window buckets
+        return (len(bounds) + 1) * (WINDOW_SLOTS + 1) + 2 + WINDOW_SLOTS
+
+    def observe(self, value, now=None):
+        bucket = bisect.bisect_left(self.bounds, value)
+        values = self.values
+        values[self.offset + bucket] += 1
+        values[self.sum_offset] += value
+        values[self.sum_offset + 1] += 1
+        period = int((time.time() if now is None else now) // WINDOW)
+        slot = period % WINDOW_SLOTS
+        start = self.window_offset + slot * self.num_buckets
+        if values[self.stamp_offset + slot] != period:
+            for i in range(start, start + self.num_buckets):
+                values[i] = 0
+            values[self.stamp_offset + slot] = period
+        values[start + bucket] += 1
+
+    def buckets(self):
+        return list(self.values[self.offset:self.offset + self.num_buckets])
+
+    def total(self):
+        return self.values[self.sum_offset], self.values[self.sum_offset + 1]
+
+    def window(self, now=None):
+        """
+        Return the bucket counts of the window and the seconds it covers
+        """
+        now = time.time() if now is None else now
+        period = int(now // WINDOW)
+        counts = [0] * self.num_buckets
+        oldest = period
+        for slot in range(WINDOW_SLOTS):
+            stamp = self.values[self.stamp_offset + slot]
+            if period - WINDOW_SLOTS < stamp <= period:
+                oldest = min(oldest, int(stamp))
+                start = self.window_offset + slot * self.num_buckets
+                for i in range(self.num_buckets):
+                    counts[i] += self.values[start + i]
+        return counts, now - oldest * WINDOW
+
+    def quantile(self, q, counts):
+        """
+        Estimate quantile <q> from bucket <counts>, interpolating linearly
+        inside the bucket as Prometheus histogram_quantile does
+        """
+        total = sum(counts)
+        if not total:
+            return float("nan")
+        rank, seen = q * total, 0
+        for i, count in enumerate(counts):
+            if seen + count >= rank and count:
+                if i == len(self.bounds):
+                    return self.bounds[-1]
+                lower = self.bounds[i - 1] if i else 0
+                return lower + (self.bounds[i] - lower) * (rank - seen) / count
+            seen += count
+        return self.bounds[-1]
+
+
+_KINDS = {COUNTER: Counter, GAUGE: Gauge, HISTOGRAM: Histogram}
+
+
+class Metrics(object):
+    """
+    Registry of counters, gauges and histograms rendered in the Prometheus
+    text format.
+
+    Series are declared up front, then start() allocates their values in
+    shared memory. Worker processes receive the registry (pickled, like
+    ShmRing) and update the series they own: every series must have a
+    single writer.
+    Local registries (started with shared=False) also accept series
+    declared once started, i.e. labelled with values seen at runtime, from
+    any thread. Each of them gets its own values, so series got before
+    keep counting.
+    """
+
+    def __init__(self, bounds=LATENCY_BUCKETS):
+        self.bounds = tuple(bounds)
+        self.families = {}
+        self.layout = {}
+        self.size = 0
+        self.values = None
+        # Values of the series declared once started: key: values
+        self.late = {}
+        self._shm = None
+        self._lock = threading.Lock()
+
+    def declare(self, kind, name, help_text, **labels):
+        if self._shm is not None:
+            raise RuntimeError("Metrics already started")
+        size = Histogram.size(self.bounds) if kind == HISTOGRAM else 1
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self.families.setdefault(name, (kind, help_text))
+            if key in self.layout:
+                return
+            if self.values is not None:
+                self.late[key] = memoryview(bytearray(size * 8)).cast('d')
+                self.layout[key] = 0
+                return
+            self.layout[key] = self.size
+            self.size += size
+
+    def start(self, shared=True):
+        """
+        Allocate the declared series, in shared memory if <shared>
+        """
+        size = max(1, self.size) * 8
+        if shared:
+            self._shm = shared_memory.SharedMemory(create=True, size=size)
+            self.values = self._shm.buf.cast('d')
+            for i in range(self.size):
+                self.values[i] = 0
+        else:
+            self.values = memoryview(bytearray(size)).cast('d')
+
+    def __getstate__(self):
+        return {'bounds': self.bounds, 'families': self.families, 'layout': self.layout,
+                'size': self.size, 'name': self._shm.name}
+
+    def __setstate__(self, state):
+        self.bounds = state['bounds']
+        self.families = state['families']
+        self.layout = state['layout']
+        self.size = state['size']
+        self.late = {}
+        self._shm = shared_memory.SharedMemory(name=state['name'])
+        self.values = self._shm.buf.cast('d')
+        self._lock = threading.Lock()
+
+    def get(self, name, **labels):
+        """
+        Return the series <name> with <labels>
+        """
+        key = (name, tuple(sorted(labels.items())))
+        offset = self.layout[key]
+        return _KINDS[self.families[name][0]](self.late.get(key, self.values), offset, self.bounds)
+
+    def close(self):
+        if self._shm is not None:
+            self.values.release()
+            self._shm.close()
+
+    def unlink(self):
+        self._shm.unlink()
+
+    def render(self):
+        """
+        Return all series in the Prometheus text format.
+        Histograms come with <name>_quantile and <name>_rate gauges computed
+        over the window.
+        """
+        lines = []
+        now = time.time()
+        # Snapshots, series may be declared meanwhile
+        layout = list(self.layout)
+        for name, (kind, help_text) in list(self.families.items()):
+            keys = [key for key in layout if key[0] == name]
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            if kind != HISTOGRAM:
+                for key in keys:
+                    lines.append(f"{name}{_labels(key[1])} {self.get(name, **dict(key[1])).get()}")
+                continue
+            quantiles, rates = [], []
+            for key in keys:
+                series = self.get(name, **dict(key[1]))
+                cumulative = 0
+                for bound, count in zip(self.bounds + ("+Inf",), series.buckets()):
+                    cumulative += count
+                    lines.append(f"{name}_bucket{_labels(key[1], le=bound)} {cumulative}")
+                total, count = series.total()
+                lines.append(f"{name}_sum{_labels(key[1])} {total}")
+                lines.append(f"{name}_count{_labels(key[1])} {count}")
+                counts, seconds = series.window(now)
+                for q in QUANTILES:
+                    quantiles.append(f"{name}_quantile{_labels(key[1], quantile=q)} {series.quantile(q, counts)}")
+                rates.append(f"{name}_rate{_labels(key[1])} {sum(counts) / seconds if seconds > 0 else 0}")
+            lines.append(f"# HELP {name}_quantile {help_text}, quantiles over the last {WINDOW * WINDOW_SLOTS}s")
+            lines.append(f"# TYPE {name}_quantile gauge")
+            lines.extend(quantiles)
+            lines.append(f"# HELP {name}_rate {help_text}, observations per second over the last {WINDOW * WINDOW_SLOTS}s")
+            lines.append(f"# TYPE {name}_rate gauge")
+            lines.extend(rates)
+        return "\n".join(lines) + "\n"
+
+
+def serve(metrics, log, port=None):
+    """
+    Serve <metrics> at /metrics on <port> (METRICS_PORT by default) from a
+    daemon thread, for services without a web server.
+    Return the server, or None when no port is configured.
+    """
+    port = port or os.getenv("METRICS_PORT")
+    if not port:
+        return None
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path != "/metrics":
+                self.send_error(404)
+                return
+            body = metrics.render().encode()
+            self.send_response(200)
+            self.send_header("Content-Type", CONTENT_TYPE)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = http.server.ThreadingHTTPServer(("", int(port)), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    log.info(f"Serving metrics on port {port}")
+    return server
+
+
+def _labels(labels, **extra):
+    pairs = [f'{key}="{value}"' for key, value in labels + tuple(extra.items())]
+    return "{" + ",".join(pairs) + "}" if pairs else ""
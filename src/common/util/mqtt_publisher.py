@@ -10,36 +10,171 @@ WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 See the License for the specific language governing permissions and
 limitations under the License.
 """
+import collections
 import paho.mqtt.client as mqtt
 import socket
-import zlib
-import time
+from common.util import frame_codec, image_channel
 
-def start(queue, topic, mqtt_broker, mqtt_port, log):
+# Seconds to wait for the oldest in-flight message when the window is full
+# before it is considered lost.
+PUBLISH_TIMEOUT = 5
+# Seconds to wait for queued frames before checking in-flight messages
+# again. With nothing in flight the publisher blocks until a frame arrives.
+QUEUE_TIMEOUT = 0.1
+
+
+class PublisherStats:
+    """
+    Counters of a publisher topic. Frames are dropped when publishing
+    fails, and overflowed when the queue is full before they are published.
+    """
+    def __init__(self):
+        self.published = 0
+        self.dropped = 0
+        self.overflowed = 0
+        self.in_flight = 0
+
+    def as_dict(self):
+        return {'published': self.published,
+                'dropped': self.dropped + self.overflowed,
+                'overflowed': self.overflowed,
+                'in_flight': self.in_flight}
+
+
+class _Topic:
+    """
+    Publishing state of <topic>: its <queue>, in-flight window, counters in
+    <stats> and split images in <image_store>
+    """
+    def __init__(self, topic, queue, stats, image_store=None):
+        self.topic = topic
+        self.queue = queue
+        self.stats = stats
+        self.image_store = image_store
+        self.inflight = collections.deque()
+
+    def release_published(self):
+        while self.inflight and self.inflight[0].is_published():
+            self.inflight.popleft()
+            self.stats.published += 1
+        self.stats.in_flight = len(self.inflight)
+
+    def wait_for_window(self, inflight_window, log):
+        self.release_published()
+        while len(self.inflight) >= inflight_window:
+            self.inflight[0].wait_for_publish(PUBLISH_TIMEOUT)
+            if not self.inflight[0].is_published():
+                log.warning(f"{self.topic} Message not published after {PUBLISH_TIMEOUT}s, dropping")
+                self.inflight.popleft()
+                self.stats.dropped += 1
+            self.release_published()
+
+    def publish(self, mqtt_c, frame, encode, inflight_window, log):
+        """
+        Publish <frame> once the in-flight window has room.
+        With an image store, images of frames with an img_handle are kept
+        in the store and only the frame metadata is published. Other
+        frames are published with their image.
+        """
+        if self.image_store is not None and 'img' in frame and 'img_handle' in frame:
+            self.image_store.put(frame['img_handle'], bytes(frame.pop('img')))
+            frame['img_topic'] = self.topic
+        self.wait_for_window(inflight_window, log)
+        info = mqtt_c.publish(self.topic, encode(frame), qos=0, retain=False)
+        if info.rc != mqtt.MQTT_ERR_SUCCESS:
+            log.debug(f"{self.topic} Publish failed: {mqtt.error_string(info.rc)}")
+            self.stats.dropped += 1
+        else:
+            self.inflight.append(info)
+        self.stats.in_flight = len(self.inflight)
+
+
+def _pump(mqtt_c, topics, log, encode, inflight_window, batch_size):
+    """
+    Publish the frames queued for every _Topic of <topics> on a connected
+    client, taking up to <batch_size> frames of each queue in turn.
+    Topics may share a queue, distinct queues must share their condition:
+    the pump blocks on it until any of them has frames, or for up to
+    QUEUE_TIMEOUT while messages are in flight.
+    """
+    queues = list({id(topic.queue): topic.queue for topic in topics}.values())
+
+    def ready():
+        return any(len(queue) for queue in queues)
+
+    while True:
+        timeout = QUEUE_TIMEOUT if any(topic.inflight for topic in topics) else None
+        if len(queues) == 1:
+            queues[0].wait(timeout)
+        else:
+            queues[0].wait(timeout, ready)
+        for topic in topics:
+            frames = topic.queue.drain(batch_size, 0)
+            topic.stats.overflowed = topic.queue.overflow()
+            for frame in frames:
+                topic.publish(mqtt_c, frame, encode, inflight_window, log)
+            topic.release_published()
+
+
+def start(queue, topic, mqtt_broker, mqtt_port, log, wire_format=frame_codec.WIRE_BINARY,
+          inflight_window=1, batch_size=1, sndbuf=0, stats=None):
+    """
+    Publish frames from <queue> to <topic>.
+    Up to <inflight_window> messages are handed to the network loop without
+    waiting for them to be written, and up to <batch_size> queued frames are
+    published on each loop iteration. inflight_window=1 publishes one
+    message per round trip.
+    """
+    stats = stats if stats is not None else PublisherStats()
+    start_multiplexed({topic: queue}, mqtt_broker, mqtt_port, log, wire_format,
+                      inflight_window, batch_size, sndbuf, {topic: stats})
+
+
+def start_multiplexed(queues, mqtt_broker, mqtt_port, log, wire_format=frame_codec.WIRE_BINARY,
+                      inflight_window=1, batch_size=1, sndbuf=0, stats=None, image_stores=None):
+    """
+    Publish frames from every queue in <queues> to its topic over a single
+    connection and network loop, from one thread. Distinct queues must
+    share their condition, so that thread can wait for all of them. Each
+    topic keeps its own in-flight window and counters in <stats>, and its
+    split images in <image_stores>, whose requests are answered on the same
+    connection.
+    """
     mqtt_c = None
+    name = " ".join(queues)
+    encode = frame_codec.get_encoder(wire_format)
+    stats = stats if stats is not None else {}
+    image_stores = image_stores if image_stores is not None else {}
+    stores = {topic: image_stores[topic] for topic in queues if topic in image_stores}
 
     def on_log(client, userdata, level, buf):
-        log.debug(f"{topic} MQTT on_LOG : {buf}")
+        log.debug(f"{name} MQTT on_LOG : {buf}")
 
+    def on_connect(client, userdata, flags, rc):
+        # Subscribed again after reconnections
+        if rc == 0 and stores:
+            client.subscribe(image_channel.request_topics(stores))
 
     try:
-        log.info(f"{topic} Initializing publisher")
+        log.info(f"{name} Initializing publisher")
         mqtt_c = mqtt.Client()
         mqtt_c.on_log = on_log
+        mqtt_c.on_connect = on_connect
+        mqtt_c.on_message = image_channel.request_handler(stores, log)
         mqtt_c.connect(mqtt_broker, int(mqtt_port), 600)
-        mqtt_c.socket().setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 2048)
-        log.info(f"{topic} Running...")
+        if sndbuf:
+            mqtt_c.socket().setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, sndbuf)
+        log.info(f"{name} Running... (wire format: {wire_format}, "
+                 f"in-flight window: {inflight_window}, batch size: {batch_size})")
         mqtt_c.loop_start()
 
-        while True:
-            if queue:
-                mqtt_c.publish(topic, zlib.compress(str(queue.popleft()).encode()), qos=0, retain=False).wait_for_publish()
-            else:
-                time.sleep(0.005)
+        topics = [_Topic(topic, queue, stats.setdefault(topic, PublisherStats()), image_stores.get(topic))
+                  for topic, queue in queues.items()]
+        _pump(mqtt_c, topics, log, encode, inflight_window, batch_size)
     except KeyboardInterrupt:
-        log.info(f"{topic} Quitting...")
+        log.info(f"{name} Quitting...")
     finally:
         if mqtt_c:
             mqtt_c.loop_stop()
             mqtt_c.disconnect()
-        log.info(f"{topic} Finishing...")
+        log.info(f"{name} Finishing...")
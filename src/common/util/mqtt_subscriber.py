@@ -11,31 +11,47 @@ See the License for the specific language governing permissions and
 limitations under the License.
 """
 import paho.mqtt.client as mqtt
-import ast
-import zlib
+from common.util import frame_codec
 
 def start(queue, topic, broker, port, log):
+    start_multiplexed({topic: queue}, broker, port, log)
+
+
+def start_multiplexed(queues, broker, port, log):
+    """
+    Subscribe to every topic in <queues> on a single connection and
+    append the frames of each topic to its queue.
+    """
     mqtt_c = None
+    name = " ".join(queues)
+
     def on_log(client, userdata, level, buf):
-        log.debug(f"{topic} MQTT on_log: {buf}")
+        log.debug(f"{name} MQTT on_log: {buf}")
 
     def on_message(_, __, msg):
-        queue.append(ast.literal_eval(zlib.decompress(msg.payload).decode()))
+        queue = queues.get(msg.topic)
+        if queue is None:
+            log.debug(f"{msg.topic} Unexpected topic")
+            return
+        try:
+            queue.append(frame_codec.decode(msg.payload))
+        except ValueError as err:
+            log.error(f"{msg.topic} Dropping malformed frame: {err}")
 
     try:
-        log.debug(f"{topic} Initializing subscriber")
+        log.debug(f"{name} Initializing subscriber")
         mqtt_c = mqtt.Client()
         mqtt_c.on_message = on_message
         mqtt_c.on_log = on_log
         mqtt_c.connect(broker, int(port), 600)
-        mqtt_c.subscribe(topic)
-        log.info(f"{topic} Running...")
+        mqtt_c.subscribe([(topic, 0) for topic in queues])
+        log.info(f"{name} Running...")
         mqtt_c.loop_forever()
     except KeyboardInterrupt:
-        log.info(f"{topic} Quitting...")
+        log.info(f"{name} Quitting...")
     finally:
         if mqtt_c:
             mqtt_c.loop_stop()
-            mqtt_c.unsubscribe(topic)
+            mqtt_c.unsubscribe(list(queues))
             mqtt_c.disconnect()
-        log.info(f"{topic} Finishing...")
+        log.info(f"{name} Finishing...")
@@ -13,8 +13,11 @@ limitations under the License.
 import common.util.mqtt_publisher as mqtt
 import threading
 import os
+from common.util import frame_codec, image_channel
 
 pub_threads = []
+pub_stats = {}
+image_stores = {}
 
 
 def get_env_values(logger):
@@ -33,24 +36,98 @@ def get_env_values(logger):
     return topic, mqtt_port, mqtt_broker
 
 
-def configure(logger, out_queue, queue_module=None, queue_len=0):
+def get_wire_format(logger):
+    """
+    Wire format used to publish frames. Subscribers accept both formats,
+    so publishers can be switched one at a time during rollout.
+    """
+    wire_format = os.getenv("MQTT_WIRE_FORMAT", frame_codec.WIRE_BINARY).lower()
+    if wire_format not in frame_codec.WIRE_FORMATS:
+        logger.error(f"Unknown MQTT_WIRE_FORMAT {wire_format}, using {frame_codec.WIRE_BINARY}")
+        wire_format = frame_codec.WIRE_BINARY
+    return wire_format
+
+
+def _get_int_env(logger, name, default):
+    value = os.getenv(name, None)
+    if not value:
+        return default
+    try:
+        return max(0, int(value))
+    except ValueError:
+        logger.error(f"{name} must be an integer, using {default}")
+        return default
+
+
+def get_pipeline_values(logger):
+    """
+    In-flight window, batch size and socket send buffer of the publishers.
+    MQTT_INFLIGHT_WINDOW=1 waits for every message to be written before
+    publishing the next one. MQTT_SNDBUF=0 keeps the OS default.
+    """
+    inflight_window = max(1, _get_int_env(logger, "MQTT_INFLIGHT_WINDOW", 16))
+    batch_size = max(1, _get_int_env(logger, "MQTT_PUBLISH_BATCH", 4))
+    sndbuf = _get_int_env(logger, "MQTT_SNDBUF", 0)
+    return inflight_window, batch_size, sndbuf
+
+
+def is_multiplexed():
+    """
+    MQTT_MULTIPLEX=true publishes all topics over one connection
+    """
+    return os.getenv("MQTT_MULTIPLEX", "false").lower() == "true"
+
+
+def configure(logger, out_queue, queue_module=None, queue_len=0, split_images=False):
+    """
+    Start the publishers of the PUBLISHER_TOPIC topics.
+    With <split_images>, frames are published without their image, which
+    is kept for the subscribers requesting it (see image_channel).
+    """
     topic, mqtt_port, mqtt_broker = get_env_values(logger)
     if not topic:
         return False
+    wire_format = get_wire_format(logger)
+    inflight_window, batch_size, sndbuf = get_pipeline_values(logger)
+    queues = {}
+    # The single publisher of a multiplexed group waits for all its queues
+    wakeup = queue_module.condition() if isinstance(out_queue, dict) and is_multiplexed() else None
     for topic in topic.split():
         o_queue = out_queue
         if isinstance(out_queue, dict):
-            out_queue[topic] = queue_module.deque(maxlen=queue_len)
+            if wakeup is not None:
+                out_queue[topic] = queue_module.deque(maxlen=queue_len, cond=wakeup)
+            else:
+                out_queue[topic] = queue_module.deque(maxlen=queue_len)
             o_queue = out_queue[topic]
+        queues[topic] = o_queue
+        pub_stats[topic] = mqtt.PublisherStats()
+        if split_images:
+            # Requests are answered by the publisher of the topic
+            image_stores[topic] = image_channel.ImageStore(image_channel.get_store_size())
+    if is_multiplexed():
+        groups = [queues]
+    else:
+        groups = [{topic: queue} for topic, queue in queues.items()]
+    for group in groups:
         t = threading.Thread(
-            target=mqtt.start,
-            args=(o_queue, topic, mqtt_broker, mqtt_port, logger)
+            target=mqtt.start_multiplexed,
+            args=(group, mqtt_broker, mqtt_port, logger, wire_format,
+                  inflight_window, batch_size, sndbuf, pub_stats, image_stores)
         )
         pub_threads.append(t)
         t.start()
     return True
 
 
+def get_stats():
+    """
+    Return published, dropped (overflowed included), overflowed and
+    in-flight counters for each topic
+    """
+    return {topic: stats.as_dict() for topic, stats in pub_stats.items()}
+
+
 def join():
     for thread in pub_threads:
         thread.join()
\ No newline at end of file
@@ -11,6 +11,7 @@ See the License for the specific language governing permissions and
 limitations under the License.
 """
 import collections
+import threading
 from multiprocessing.managers import BaseManager
 
 
@@ -18,18 +19,64 @@ class SharedDequeManager(BaseManager):
     pass
 
 class SharedDeque(object):
+    """
+    Bounded deque whose consumers can block until items are appended,
+    instead of polling it. Deques created with the same <cond> can be
+    waited on together.
+    """
 
-    def __init__(self, **kwargs):
+    def __init__(self, cond=None, **kwargs):
         self.deque = collections.deque(**kwargs)
+        self.cond = cond if cond is not None else threading.Condition()
+        self.dropped = 0
 
     def __len__(self):
         return self.deque.__len__()
 
     def append(self, x):
-        self.deque.append(x)
+        with self.cond:
+            if self.deque.maxlen is not None and len(self.deque) == self.deque.maxlen:
+                self.dropped += 1
+            self.deque.append(x)
+            self.cond.notify_all()
 
-    def popleft(self):
-        return self.deque.popleft()
+    def overflow(self):
+        """
+        Return the number of items evicted by appends to the full deque
+        """
+        return self.dropped
+
+    def wait(self, timeout=None, ready=None):
+        """
+        Wait up to <timeout> seconds (forever if None) for an item, or
+        until <ready>() is true for deques sharing the condition.
+        Return whether it happened.
+        """
+        with self.cond:
+            return self.cond.wait_for(ready or self.__len__, timeout)
+
+    def popleft(self, block=False, timeout=None):
+        """
+        Remove and return the leftmost item.
+        If <block> is set, wait up to <timeout> seconds (forever if None)
+        for an item. Raise IndexError if the deque is still empty.
+        """
+        with self.cond:
+            if block:
+                self.cond.wait_for(self.__len__, timeout)
+            return self.deque.popleft()
+
+    def drain(self, max_n=None, timeout=None):
+        """
+        Remove and return up to <max_n> items (all if None) as a list.
+        Wait up to <timeout> seconds (forever if None) for the first item,
+        return an empty list if none arrived.
+        """
+        with self.cond:
+            if timeout != 0:
+                self.cond.wait_for(self.__len__, timeout)
+            n = len(self.deque) if max_n is None else min(max_n, len(self.deque))
+            return [self.deque.popleft() for _ in range(n)]
 
 SharedDequeManager.register('deque', SharedDeque,
-                            exposed=['__len__', 'append', 'popleft'])
\ No newline at end of file
+                            exposed=['__len__', 'append', 'wait', 'popleft', 'drain', 'overflow'])
\ No newline at end of file
@@ -0,0 +1,249 @@
+"""
+Copyright 2022 Intel Corporation
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+    http://www.apache.org/licenses/LICENSE-2.0
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+import multiprocessing as mp
+import numpy as np
+import struct
+import threading
+from multiprocessing import shared_memory
+from common.util import frame_codec
+from common.util.logger import get_logger
+
+log = get_logger(__name__)
+
+DEFAULT_SLOT_SIZE = 1 << 20
+
+# Ring header: | write sequence (Q) | dropped items (Q) |
+_RING_HEADER = struct.Struct("=QQ")
+# Slot header: | sequence (Q) | payload length (Q) |
+_SLOT_HEADER = struct.Struct("=QQ")
+# Metadata key describing numpy arrays carried as raw blobs
+_ARRAYS_KEY = "_arrays"
+# Key used to carry a bare numpy array
+_ARRAY_ITEM = "_item"
+
+
+class ShmRing(object):
+    """
+    Shared memory ring buffer of fixed-size slots with a deque-like
+    interface, used to move frames between processes without pickling them.
+
+    Items are frame dicts or numpy arrays. Bytes values and arrays are
+    copied once into a slot, and readers copy the slot out before decoding
+    it. Like a seqlock, the slot sequence is checked again after the copy,
+    so items overwritten while being read count as lapped instead of
+    tearing. Popped items never change under the reader.
+
+    Any number of processes may append. Every attached process has its own
+    read cursor, shared by the threads of that process. When a reader falls
+    more than <slots> items behind, the oldest items are skipped, like a
+    full deque with maxlen.
+    Rings created with the same multiprocessing <cond> can be waited on
+    together.
+    """
+
+    def __init__(self, slots, slot_size=DEFAULT_SLOT_SIZE, cond=None):
+        self.slots = slots
+        self.slot_size = slot_size
+        self._shm = shared_memory.SharedMemory(
+            create=True, size=_RING_HEADER.size + slots * slot_size)
+        _RING_HEADER.pack_into(self._shm.buf, 0, 0, 0)
+        self._cond = cond if cond is not None else mp.Condition()
+        self._wlock = mp.Lock()
+        self._init_reader()
+
+    def __getstate__(self):
+        return {'name': self._shm.name, 'slots': self.slots,
+                'slot_size': self.slot_size, 'cond': self._cond,
+                'wlock': self._wlock}
+
+    def __setstate__(self, state):
+        self.slots = state['slots']
+        self.slot_size = state['slot_size']
+        self._shm = shared_memory.SharedMemory(name=state['name'])
+        self._cond = state['cond']
+        self._wlock = state['wlock']
+        self._init_reader()
+
+    def _init_reader(self):
+        self._rlock = threading.Lock()
+        self._read_seq = self._write_seq()
+        # Items this process skipped because writers lapped its cursor
+        self.lapped = 0
+        self._logged_oversize = False
+
+    def _write_seq(self):
+        return _RING_HEADER.unpack_from(self._shm.buf, 0)[0]
+
+    def _slot_offset(self, seq):
+        return _RING_HEADER.size + ((seq - 1) % self.slots) * self.slot_size
+
+    @property
+    def dropped(self):
+        """
+        Items dropped because they did not fit in a slot
+        """
+        return _RING_HEADER.unpack_from(self._shm.buf, 0)[1]
+
+    def __len__(self):
+        return min(self._write_seq() - self._read_seq, self.slots)
+
+    def overflow(self):
+        """
+        Return the number of items this process lost: too large for a slot,
+        or overwritten before it read them
+        """
+        return self.dropped + self.lapped
+
+    def append(self, item):
+        frame = {_ARRAY_ITEM: item} if isinstance(item, np.ndarray) else dict(item)
+        arrays = {}
+        for key, value in frame.items():
+            if isinstance(value, np.ndarray):
+                value = np.ascontiguousarray(value)
+                arrays[key] = [value.dtype.str, value.shape]
+                frame[key] = memoryview(value.reshape(-1).view(np.uint8))
+        if arrays:
+            frame[_ARRAYS_KEY] = arrays
+        parts = frame_codec.encode_parts(frame)
+        size = sum(len(part) if isinstance(part, (bytes, bytearray)) else part.nbytes
+                   for part in parts)
+        buf = self._shm.buf
+        if size > self.slot_size - _SLOT_HEADER.size:
+            with self._wlock:
+                write_seq, dropped = _RING_HEADER.unpack_from(buf, 0)
+                _RING_HEADER.pack_into(buf, 0, write_seq, dropped + 1)
+            if not self._logged_oversize:
+                self._logged_oversize = True
+                log.error(f"Dropping items of {size} bytes, larger than the {self.slot_size} bytes "
+                          f"ring slots: raise shm_slot_size")
+            return
+        with self._wlock:
+            write_seq, dropped = _RING_HEADER.unpack_from(buf, 0)
+            seq = write_seq + 1
+            offset = self._slot_offset(seq)
+            # Readers ignore the slot until its sequence is set back
+            _SLOT_HEADER.pack_into(buf, offset, 0, 0)
+            pos = offset + _SLOT_HEADER.size
+            for part in parts:
+                end = pos + (len(part) if isinstance(part, (bytes, bytearray)) else part.nbytes)
+                buf[pos:end] = part
+                pos = end
+            _SLOT_HEADER.pack_into(buf, offset, seq, size)
+            _RING_HEADER.pack_into(buf, 0, seq, dropped)
+        with self._cond:
+            self._cond.notify_all()
+
+    def _read(self, seq):
+        offset = self._slot_offset(seq)
+        buf = self._shm.buf
+        slot_seq, size = _SLOT_HEADER.unpack_from(buf, offset)
+        if slot_seq != seq:
+            return None
+        start = offset + _SLOT_HEADER.size
+        payload = bytearray(buf[start:start + size])
+        # A writer lapping us reset the sequence while we copied
+        if _SLOT_HEADER.unpack_from(buf, offset)[0] != seq:
+            return None
+        # Blobs and arrays are views into the private copy
+        frame = frame_codec.decode(payload, copy=False)
+        for key, (dtype, shape) in frame.pop(_ARRAYS_KEY, {}).items():
+            frame[key] = np.frombuffer(frame[key], dtype=dtype).reshape(shape)
+        if _ARRAY_ITEM in frame:
+            return frame[_ARRAY_ITEM]
+        return frame
+
+    def wait(self, timeout=None, ready=None):
+        """
+        Wait up to <timeout> seconds (forever if None) for an item, or
+        until <ready>() is true for rings sharing the condition.
+        Return whether it happened.
+        """
+        with self._cond:
+            return self._cond.wait_for(ready or self.__len__, timeout)
+
+    def popleft(self, block=False, timeout=None):
+        """
+        Remove and return the oldest unread item.
+        If <block> is set, wait up to <timeout> seconds (forever if None)
+        for an item. Raise IndexError if there is nothing to read.
+        """
+        if block:
+            with self._cond:
+                self._cond.wait_for(self.__len__, timeout)
+        with self._rlock:
+            while True:
+                write_seq = self._write_seq()
+                if write_seq <= self._read_seq:
+                    raise IndexError('pop from an empty ring')
+                read_seq = max(self._read_seq, write_seq - self.slots) + 1
+                self.lapped += read_seq - self._read_seq - 1
+                self._read_seq = read_seq
+                item = self._read(self._read_seq)
+                # None: the slot was overwritten by a writer that lapped us
+                if item is not None:
+                    return item
+                self.lapped += 1
+
+    def drain(self, max_n=None, timeout=None):
+        """
+        Remove and return up to <max_n> items (all if None) as a list.
+        Wait up to <timeout> seconds (forever if None) for the first item,
+        return an empty list if none arrived.
+        """
+        items = []
+        try:
+            items.append(self.popleft(block=timeout != 0, timeout=timeout))
+            while max_n is None or len(items) < max_n:
+                items.append(self.popleft())
+        except IndexError:
+            pass
+        return items
+
+    def close(self):
+        self._shm.close()
+
+    def unlink(self):
+        self._shm.unlink()
+
+
+class ShmRingManager(object):
+    """
+    Creates ShmRing objects through the same deque(maxlen=...) call as
+    SharedDequeManager proxies, and releases them on shutdown.
+    """
+
+    def __init__(self, slot_size=DEFAULT_SLOT_SIZE):
+        self.slot_size = slot_size
+        self.rings = []
+
+    def deque(self, maxlen, cond=None):
+        ring = ShmRing(maxlen, self.slot_size, cond)
+        self.rings.append(ring)
+        return ring
+
+    @staticmethod
+    def condition():
+        """
+        Return a condition for rings waited on together
+        """
+        return mp.Condition()
+
+    def shutdown(self):
+        for ring in self.rings:
+            ring.unlink()
+            try:
+                ring.close()
+            except BufferError:
+                # Items still referenced by this process keep the mapping
+                pass
+        self.rings = []
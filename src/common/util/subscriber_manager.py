@@ -34,18 +34,34 @@ def get_env_values(logger):
     return topic, mqtt_port, mqtt_broker
 
 
+def is_multiplexed():
+    """
+    MQTT_MULTIPLEX=true subscribes to all topics over one connection
+    """
+    return os.getenv("MQTT_MULTIPLEX", "false").lower() == "true"
+
+
 def configure(logger, in_queue, queue_module=None, queue_len=0):
     topic, mqtt_port, mqtt_broker = get_env_values(logger)
     if not topic:
         return False
+    # Frames are decoded according to their envelope, so binary and legacy
+    # publishers can share a topic while they are being migrated.
+    queues = {}
     for topic in topic.split():
         input_queue = in_queue
         if isinstance(in_queue, dict):
             in_queue[topic] = queue_module.deque(maxlen=queue_len)
             input_queue = in_queue[topic]
+        queues[topic] = input_queue
+    if is_multiplexed():
+        groups = [queues]
+    else:
+        groups = [{topic: queue} for topic, queue in queues.items()]
+    for group in groups:
         t = threading.Thread(
-            target=mqtt.start,
-            args=(input_queue, topic, mqtt_broker, mqtt_port, logger)
+            target=mqtt.start_multiplexed,
+            args=(group, mqtt_broker, mqtt_port, logger)
         )
         sub_threads.append(t)
         t.start()
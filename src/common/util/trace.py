@@ -0,0 +1,107 @@
+"""
+Copyright 2022 Intel Corporation
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+    http://www.apache.org/licenses/LICENSE-2.0
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+import time
+from common.util import metrics as prom
+
+# ITMVideoInference stamps every frame with a per camera sequence number
+# and its capture time, then each service appends a hop
+#   [service, enter, exit]
+# to the frame hops. Times are seconds since the epoch: hops of different
+# hosts are only as accurate as their clock synchronization.
+SEQ = 'seq'
+CAPTURE_TS = 'capture_ts'
+HOPS = 'hops'
+
+HOP_SECONDS = 'itm_hop_seconds'
+E2E_SECONDS = 'itm_e2e_seconds'
+_HOP_HELP = 'Time frames spent in each hop, and in transit between hops (<from>-><to>)'
+_E2E_HELP = 'Time from capture to the end of the hop of this service'
+
+
+def enter(frame, service, now=None):
+    """
+    Start the hop of <service> in <frame>
+    """
+    frame.setdefault(HOPS, []).append([service, time.time() if now is None else now, None])
+
+
+def leave(frame, now=None):
+    """
+    End the last hop of <frame>
+    """
+    hops = frame.get(HOPS)
+    if hops:
+        hops[-1][2] = time.time() if now is None else now
+
+
+def intervals(frame):
+    """
+    Return the (hop, seconds) of the hops of <frame> and of the transits
+    between them
+    """
+    result = []
+    previous = None
+    for service, start, end in frame.get(HOPS, []):
+        if previous is not None and previous[2] is not None:
+            result.append((f"{previous[0]}->{service}", start - previous[2]))
+        if end is not None:
+            result.append((service, end - start))
+        previous = (service, start, end)
+    return result
+
+
+def declare(metrics, service, cameras, hops):
+    """
+    Declare the trace series of <service> for <cameras> and <hops> (with
+    the transits between consecutive hops), for registries that must be
+    declared up front
+    """
+    for camera in cameras:
+        metrics.declare(prom.HISTOGRAM, E2E_SECONDS, _E2E_HELP, service=service, camera=camera)
+        for i, hop in enumerate(hops):
+            if i:
+                metrics.declare(prom.HISTOGRAM, HOP_SECONDS, _HOP_HELP, service=service, camera=camera,
+                                hop=f"{hops[i - 1]}->{hop}")
+            metrics.declare(prom.HISTOGRAM, HOP_SECONDS, _HOP_HELP, service=service, camera=camera,
+                            hop=hop)
+
+
+class Tracer:
+    """
+    Observe the hops of the frames leaving <service> in the itm_hop_seconds
+    and itm_e2e_seconds histograms of <metrics>, per camera. Series not
+    declared yet are declared on first use, which local registries allow.
+    """
+
+    def __init__(self, metrics, service):
+        self.metrics = metrics
+        self.service = service
+
+    def _series(self, name, help_text, **labels):
+        try:
+            return self.metrics.get(name, service=self.service, **labels)
+        except KeyError:
+            self.metrics.declare(prom.HISTOGRAM, name, help_text, service=self.service, **labels)
+            return self.metrics.get(name, service=self.service, **labels)
+
+    def observe(self, frame, camera):
+        """
+        Observe the hops of <frame> so far, negative times of unsynchronized
+        clocks count as 0
+        """
+        for hop, seconds in intervals(frame):
+            self._series(HOP_SECONDS, _HOP_HELP, camera=camera, hop=hop).observe(max(seconds, 0))
+        hops = frame.get(HOPS)
+        if frame.get(CAPTURE_TS) is not None and hops and hops[-1][2] is not None:
+            self._series(E2E_SECONDS, _E2E_HELP, camera=camera).observe(
+                max(hops[-1][2] - frame[CAPTURE_TS], 0))